@@ -3,15 +3,2543 @@ from tkinter import ttk, filedialog, messagebox, Menu
 import os
 import json
 import csv
+import copy
 from pathlib import Path
 from datetime import datetime
 import threading
+import random
+import multiprocessing
+import sqlite3
+import queue
 import webbrowser
 import re
+import time
+import hashlib
+import heapq
+import marshal
+import math
+import bisect
+import fnmatch
+from array import array
+from collections import namedtuple, deque, Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 print("🚀 ФАЙЛ-СКАНЕР v1.0 С AI ТЕГАМИ ЗАГРУЖЕН!", datetime.now())
 
+DirListing = namedtuple('DirListing', 'root files subdirs cached stat')
+ChatReply = namedtuple('ChatReply', 'content total_tokens finish_reason')
+ProgressSnapshot = namedtuple('ProgressSnapshot', 'files bytes directory expected rate eta extensions')
+# Настройки сканирования, снятые с переменных Tk в главном потоке: потоки конвейера
+# читают только их (route - кортеж get_ai_route)
+ScanSettings = namedtuple('ScanSettings', 'include_hidden file_extensions scan_threads incremental_scan use_sqlite '
+                          'ai_enabled tag_processes rules tag_rules openai_enabled openai_api_key openai_base_url '
+                          'openai_model openai_workers openai_batching openai_deadline daily_limit '
+                          'enable_cache cache_max_entries learned_tagger learned_threshold '
+                          'cluster_templates route')
+
+
+def format_timestamp(timestamp):
+    """Дата из st_mtime/st_ctime в формате отчетов"""
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class DirectoryTable:
+    """Таблица папок: родитель и имя, полные пути собираются по запросу"""
+    
+    CACHE_SIZE = 4096
+    
+    def __init__(self, root):
+        self.parents = [-1]
+        self.names = [root]
+        self.path_cache = {}
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def add(self, parent_id, name):
+        """Добавить папку; id потомка всегда больше id родителя"""
+        dir_id = len(self.names)
+        self.parents.append(parent_id)
+        self.names.append(name)
+        return dir_id
+    
+    def path(self, dir_id):
+        """Полный путь папки (как его строил os.walk: join от корня сканирования)"""
+        path = self.path_cache.get(dir_id)
+        if path is not None:
+            return path
+        
+        names = []
+        current = dir_id
+        while current >= 0:
+            path = self.path_cache.get(current)
+            if path is not None:
+                break
+            names.append(self.names[current])
+            current = self.parents[current]
+        if path is None:
+            path = names.pop()
+        for name in reversed(names):
+            path = os.path.join(path, name)
+        
+        if len(self.path_cache) >= self.CACHE_SIZE:
+            self.path_cache.clear()
+        self.path_cache[dir_id] = path
+        return path
+    
+    def relative(self, dir_id):
+        """Путь папки относительно корня сканирования ('' для самого корня)"""
+        names = []
+        while self.parents[dir_id] >= 0:
+            names.append(self.names[dir_id])
+            dir_id = self.parents[dir_id]
+        return os.path.join(*reversed(names)) if names else ''
+
+
+class FileRecord:
+    """Запись о файле: сырые числа из stat, строки форматируются только при показе"""
+    
+    __slots__ = ('name', 'dirs', 'dir_id', 'extension',
+                 'size_bytes', 'mtime', 'ctime', 'ai_tags')
+    
+    def __init__(self, name, dirs, dir_id, extension,
+                 size_bytes, mtime, ctime, ai_tags=None):
+        self.name = name
+        self.dirs = dirs
+        self.dir_id = dir_id
+        self.extension = extension
+        self.size_bytes = size_bytes
+        self.mtime = mtime
+        self.ctime = ctime
+        self.ai_tags = ai_tags if ai_tags is not None else []
+    
+    @property
+    def directory(self):
+        return self.dirs.path(self.dir_id)
+    
+    @property
+    def full_path(self):
+        return os.path.join(self.dirs.path(self.dir_id), self.name)
+    
+    @property
+    def relative_path(self):
+        return os.path.join(self.dirs.relative(self.dir_id), self.name)
+    
+    @property
+    def size_mb(self):
+        return round(self.size_bytes / (1024 * 1024), 3)
+    
+    @property
+    def modified_date(self):
+        return format_timestamp(self.mtime)
+    
+    @property
+    def created_date(self):
+        return format_timestamp(self.ctime)
+    
+    def to_dict(self):
+        """Запись в прежнем формате JSON/CSV экспорта"""
+        return {
+            'name': self.name,
+            'full_path': self.full_path,
+            'relative_path': self.relative_path,
+            'directory': self.directory,
+            'extension': self.extension,
+            'size_bytes': self.size_bytes,
+            'size_mb': self.size_mb,
+            'modified_date': self.modified_date,
+            'created_date': self.created_date,
+            'ai_tags': self.ai_tags
+        }
+
+
+REGEX_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+
+
+def literal_trie_pattern(words):
+    """Регулярное выражение из префиксного дерева литералов: общие префиксы проверяются один раз"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        # Поиск подстроки: если короткий литерал совпал, более длинные с тем же началом не нужны
+        node.clear()
+        node[''] = True
+    
+    def emit(node):
+        if '' in node:
+            return ''
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items())]
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+    
+    return emit(trie)
+
+
+class MultiRegex:
+    """Набор выражений с интерфейсом одного: для паттернов, которые нельзя склеить"""
+    
+    def __init__(self, regexes):
+        self.regexes = regexes
+    
+    def search(self, text):
+        for regex in self.regexes:
+            match = regex.search(text)
+            if match:
+                return match
+        return None
+
+
+class TagRules:
+    """Скомпилированные правила AI тегов: одно регулярное выражение на категорию"""
+    
+    def __init__(self, ai_tag_patterns):
+        self.categories = []
+        for category, data in ai_tag_patterns.items():
+            compiled = self.compile_category(category, data.get('patterns', []))
+            if compiled is not None:
+                self.categories.append((compiled[0], compiled[1], list(data.get('tags', []))))
+    
+    @staticmethod
+    def compile_category(category, patterns):
+        """(выражение для пути, выражение только для имени или None)"""
+        literals = []
+        regexes = []
+        for pattern in patterns:
+            if not any(char in REGEX_SPECIAL_CHARS for char in pattern):
+                literals.append(pattern)
+                continue
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                print(f"Пропущен неверный паттерн '{pattern}' в категории '{category}': {e}")
+                continue
+            regexes.append(pattern)
+        
+        # Имя файла - это конец полного пути, поэтому совпадение в имени есть и в пути.
+        # Исключение - привязка к началу строки и просмотр назад: такие паттерны
+        # дополнительно проверяются по одному имени
+        name_only = [p for p in regexes if '^' in p or '\\A' in p or '(?<' in p]
+        
+        branches = []
+        if literals:
+            branches.append(literal_trie_pattern(literals))
+        branches.extend(f'(?P<p{index}>{pattern})' for index, pattern in enumerate(regexes))
+        if not branches:
+            return None
+        
+        path_regex = TagRules.compile_alternation(branches, regexes)
+        name_regex = None
+        if name_only:
+            name_regex = TagRules.compile_alternation(
+                [f'(?P<p{index}>{pattern})' for index, pattern in enumerate(name_only)], name_only)
+        return path_regex, name_regex
+    
+    @staticmethod
+    def compile_alternation(branches, regexes):
+        """Склеить ветки в одно выражение; паттерны с обратными ссылками проверяются отдельно"""
+        separate = MultiRegex([re.compile(pattern) for pattern in regexes] +
+                              [re.compile(branch) for branch in branches if not branch.startswith('(?P<p')])
+        if any(re.search(r'\\[1-9]|\(\?P[=<]|\(\?[aiLmsux]+\)', pattern) for pattern in regexes):
+            return separate
+        try:
+            return re.compile('|'.join(branches))
+        except re.error:
+            return separate
+    
+    def match(self, filename, filepath):
+        """Теги всех категорий, чьи паттерны встречаются в имени или пути"""
+        tags = set()
+        for path_regex, name_regex, category_tags in self.categories:
+            if path_regex.search(filepath) or (name_regex is not None and name_regex.search(filename)):
+                tags.update(category_tags)
+        return tags
+
+
+def local_ai_tags(tag_rules, filename, filepath, extension, size_mb, mtime):
+    """Локальные теги по правилам, размеру, возрасту и расширению (строки в нижнем регистре)"""
+    tags = tag_rules.match(filename, filepath)
+    
+    if size_mb > 1000:
+        tags.add('большой')
+    elif size_mb > 100:
+        tags.add('средний')
+    else:
+        tags.add('маленький')
+    
+    try:
+        days_old = (datetime.now() - datetime.fromtimestamp(mtime)).days
+        
+        if days_old < 7:
+            tags.add('новый')
+        elif days_old < 30:
+            tags.add('недавний')
+        elif days_old > 365:
+            tags.add('старый')
+    except:
+        pass
+    
+    if extension in ['.exe', '.msi', '.dmg']:
+        tags.add('приложение')
+    elif extension in ['.txt', '.doc', '.docx', '.pdf']:
+        tags.add('документ')
+    elif extension in ['.jpg', '.png', '.gif', '.bmp']:
+        tags.add('изображение')
+    elif extension in ['.mp3', '.wav', '.flac']:
+        tags.add('аудио')
+    elif extension in ['.mp4', '.avi', '.mkv']:
+        tags.add('видео')
+    
+    return tags
+
+
+worker_tag_rules = None
+
+
+def init_tag_worker(ai_tag_patterns):
+    """Инициализация процесса-тегировщика: правила компилируются один раз на процесс"""
+    global worker_tag_rules
+    worker_tag_rules = TagRules(ai_tag_patterns)
+
+
+def tag_chunk(rows):
+    """Задача процесса: локальные теги для строк (имя, путь, расширение, MB, mtime)"""
+    return [list(local_ai_tags(worker_tag_rules, *row)) for row in rows]
+
+
+class ScanIndex:
+    """Сохраняемый индекс папок: mtime и inode папки плюс записи ее файлов"""
+    
+    VERSION = 1
+    
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.dirs = {}
+        self.new_dirs = {}
+        self.previous_scan_ns = 0
+        self.scan_started_ns = time.time_ns()
+        self.reused_dirs = 0
+    
+    def load(self):
+        """Загрузить индекс прошлого сканирования, если он подходит по настройкам"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        
+        if data.get('version') != self.VERSION or data.get('params') != self.params:
+            return False
+        
+        self.dirs = data.get('dirs', {})
+        self.previous_scan_ns = data.get('scanned_at', 0)
+        return True
+    
+    def lookup(self, dir_path, dir_stat):
+        """Записи папки из индекса, если папка не менялась с прошлого сканирования"""
+        entry = self.dirs.get(dir_path)
+        if entry is None or dir_stat is None:
+            return None
+        if entry['mtime'] != dir_stat.st_mtime_ns:
+            return None
+        if entry['ino'] and dir_stat.st_ino and entry['ino'] != dir_stat.st_ino:
+            return None
+        # Папку, измененную за секунды до прошлого сканирования, не доверяем:
+        # изменение могло попасть в ту же отметку времени уже после чтения
+        if entry['mtime'] >= entry.get('checked', self.previous_scan_ns) - 2 * 10**9:
+            return None
+        self.reused_dirs += 1
+        return entry
+    
+    def restore(self, started_ns, dirs):
+        """Добавить папки из контрольной точки прерванного сканирования"""
+        for dir_path, entry in dirs.items():
+            entry['checked'] = started_ns
+            self.dirs[dir_path] = entry
+    
+    @staticmethod
+    def entry(dir_stat, subdirs, rows):
+        """Запись папки для индекса и контрольной точки"""
+        return {
+            'mtime': dir_stat.st_mtime_ns,
+            'ino': dir_stat.st_ino,
+            'subdirs': [os.path.basename(subdir) for subdir in subdirs],
+            'files': rows
+        }
+    
+    def remember(self, dir_path, entry):
+        """Запомнить папку для следующего сканирования"""
+        self.new_dirs[dir_path] = entry
+    
+    def save(self):
+        """Сохранить индекс текущего сканирования (папки, которых больше нет, выпадают)"""
+        data = {
+            'version': self.VERSION,
+            'params': self.params,
+            'scanned_at': self.scan_started_ns,
+            'dirs': self.new_dirs
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, self.path)
+
+
+class ScanCheckpoint:
+    """Контрольная точка долгого сканирования: готовые папки с записями, дописываемые в файл
+    
+    Сначала заголовок (папка, настройки, время начала), дальше по записи на папку в
+    порядке обхода. Записи дописываются раз в INTERVAL секунд: при обрыве теряется не
+    больше интервала работы. Формат marshal, а не JSON: запись идет по ходу сканирования,
+    и кодирование дробных mtime/ctime в JSON стоило бы ~4 мкс на файл против ~0.3 мкс.
+    Файл временный и читается той же версией Python; чужой формат считается отсутствием точки.
+    """
+    
+    VERSION = 1
+    INTERVAL = 30
+    
+    def __init__(self, path, folder, params):
+        self.path = path
+        self.folder = folder
+        self.params = params
+        self.pending = []
+        self.last_write = time.monotonic()
+    
+    def read_header(self, f):
+        """Заголовок прерванного сканирования этой папки с теми же настройками или None"""
+        try:
+            header = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return None
+        if (not isinstance(header, dict) or header.get('version') != self.VERSION
+                or header.get('folder') != self.folder or header.get('params') != self.params):
+            return None
+        return header
+    
+    def find(self):
+        """Заголовок точки, если ее можно продолжить, иначе None"""
+        try:
+            with open(self.path, 'rb') as f:
+                return self.read_header(f)
+        except OSError:
+            return None
+    
+    def load(self):
+        """(время начала прерванного сканирования в нс, {папка: запись индекса}) или None"""
+        dirs = {}
+        try:
+            with open(self.path, 'rb') as f:
+                header = self.read_header(f)
+                if header is None:
+                    return None
+                while True:
+                    try:
+                        dir_path, entry = marshal.load(f)
+                    except (EOFError, ValueError, TypeError):
+                        # Конец файла или запись, оборванная аварийным завершением
+                        break
+                    dirs[dir_path] = entry
+        except OSError:
+            return None
+        return header['started'], dirs
+    
+    def start(self, restored=None):
+        """Начать файл заново; restored - результат load() при продолжении
+        
+        Готовые папки прерванного сканирования переписываются в новый файл сразу, а старый
+        файл заменяется им через os.replace: обрыв до первой записи ничего не теряет.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        started, dirs = restored if restored is not None else (time.time_ns(), {})
+        header = {'version': self.VERSION, 'folder': self.folder, 'params': self.params,
+                  'started': started}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            marshal.dump(header, f)
+            for item in dirs.items():
+                marshal.dump(item, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.pending = []
+        self.last_write = time.monotonic()
+    
+    def add(self, dir_path, entry):
+        """Готовая папка; на диск уходит пачкой раз в INTERVAL секунд"""
+        self.pending.append(marshal.dumps((dir_path, entry)))
+        if time.monotonic() - self.last_write >= self.INTERVAL:
+            self.write()
+    
+    def write(self):
+        if self.pending:
+            with open(self.path, 'ab') as f:
+                f.write(b''.join(self.pending))
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+        self.last_write = time.monotonic()
+    
+    def remove(self):
+        """Сканирование завершено: продолжать нечего"""
+        self.pending = []
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+# Сколько прочитанных папок параллельный обход держит впереди потребителя
+WALK_READ_AHEAD = 256
+
+
+class DirectoryWalker:
+    """Однопроходный обход дерева папок через os.scandir"""
+    
+    def __init__(self, include_hidden=False, file_extensions=None, index=None):
+        self.include_hidden = include_hidden
+        self.file_extensions = file_extensions
+        self.index = index
+        self.dirs_done = 0
+        self.dirs_pending = 0
+        self.files_found = 0
+    
+    def list_directory(self, path):
+        """Прочитать одну папку: файлы (имя, DirEntry, расширение) и подпапки"""
+        # stat папки нужен индексу и контрольной точке сканирования
+        try:
+            dir_stat = os.stat(path)
+        except OSError:
+            dir_stat = None
+        if self.index is not None:
+            cached = self.index.lookup(path, dir_stat)
+            if cached is not None:
+                subdirs = [os.path.join(path, name) for name in cached['subdirs']]
+                return DirListing(path, [], subdirs, cached['files'], dir_stat)
+        
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if not self.include_hidden and name.startswith('.'):
+                        continue
+                    
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    
+                    if is_dir:
+                        # Как и os.walk, по символическим ссылкам на папки не спускаемся
+                        try:
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                        except OSError:
+                            pass
+                        continue
+                    
+                    file_ext = os.path.splitext(name)[1].lower()
+                    if self.file_extensions and file_ext not in self.file_extensions:
+                        continue
+                    # stat берет следующая стадия конвейера через entry.stat()
+                    files.append((name, entry, file_ext))
+        except OSError:
+            pass
+        return DirListing(path, files, subdirs, None, dir_stat)
+    
+    def walk(self, top):
+        """Обход сверху вниз в том же порядке, что и os.walk"""
+        stack = [top]
+        while stack:
+            listing = self.list_directory(stack.pop())
+            stack.extend(reversed(listing.subdirs))
+            self.count_listing(listing, len(stack))
+            yield listing
+    
+    def count_listing(self, listing, pending):
+        """Учесть прочитанную папку в счетчиках для оценки прогресса"""
+        self.dirs_done += 1
+        self.dirs_pending = pending
+        self.files_found += len(listing.files) + len(listing.cached or ())
+    
+    def walk_parallel(self, top, workers, running=None):
+        """Параллельный обход: папки читают N потоков, результат выдается в порядке os.walk
+        
+        Вперед читается не больше WALK_READ_AHEAD папок, а пока running сброшен
+        (пауза), потоки новые папки не берут.
+        """
+        # Ключ папки - кортеж индексов от корня. Лексикографический порядок таких
+        # ключей совпадает с порядком обхода os.walk, поэтому потоки в первую
+        # очередь берут папки, которые потребитель ждет раньше остальных
+        tasks = []
+        results = {}
+        ready = threading.Condition()
+        stop = threading.Event()
+        awaited = ()
+        reading = 0
+        
+        def can_read():
+            if not tasks or (running is not None and not running.is_set()):
+                return False
+            # Папка, которую ждет потребитель, всегда наименьшая в куче: ее читаем
+            # и при заполненном окне, иначе окно могут занять папки, нужные позже
+            return len(results) + reading < WALK_READ_AHEAD or tasks[0][0] == awaited
+        
+        def worker():
+            nonlocal reading
+            while True:
+                with ready:
+                    while not stop.is_set() and not can_read():
+                        ready.wait(0.1)
+                    if stop.is_set():
+                        return
+                    order, path = heapq.heappop(tasks)
+                    reading += 1
+                try:
+                    result = self.list_directory(path)
+                except Exception as e:
+                    result = e
+                with ready:
+                    if not isinstance(result, Exception):
+                        for index, subdir in enumerate(result.subdirs):
+                            heapq.heappush(tasks, (order + (index,), subdir))
+                    reading -= 1
+                    results[order] = result
+                    ready.notify_all()
+        
+        for _ in range(max(1, workers)):
+            threading.Thread(target=worker, daemon=True).start()
+        
+        with ready:
+            heapq.heappush(tasks, ((), top))
+        stack = [()]
+        try:
+            while stack:
+                order = stack.pop()
+                with ready:
+                    awaited = order
+                    ready.notify_all()
+                    while order not in results:
+                        ready.wait()
+                    result = results.pop(order)
+                    # Место в окне освободилось
+                    ready.notify_all()
+                if isinstance(result, Exception):
+                    raise result
+                
+                stack.extend(order + (index,) for index in reversed(range(len(result.subdirs))))
+                self.count_listing(result, len(stack))
+                yield result
+        finally:
+            stop.set()
+    
+    def estimate_total(self, previous_count=0):
+        """Оценка общего числа файлов без отдельного прохода для подсчета"""
+        if previous_count >= self.files_found:
+            return previous_count
+        if not self.dirs_done:
+            return self.files_found
+        # Средняя "плотность" уже прочитанных папок на известные, но не прочитанные
+        files_per_dir = self.files_found / self.dirs_done
+        return int(self.files_found + self.dirs_pending * files_per_dir)
+
+
+PIPELINE_CHUNK_SIZE = 256
+TAG_PROCESS_CHUNK_SIZE = 4096
+PIPELINE_QUEUE_SIZE = 64
+PIPELINE_DONE = object()
+
+
+class ScanBatch:
+    """Пакет файлов одной папки, который проходит по стадиям конвейера"""
+    
+    __slots__ = ('seq', 'dir_id', 'listing', 'entries', 'last',
+                 'records', 'rows', 'templates', 'local_tags', 'learned_tags', 'tagged')
+    
+    def __init__(self, seq, dir_id, listing, entries, last):
+        self.seq = seq
+        self.dir_id = dir_id
+        self.listing = listing
+        self.entries = entries
+        self.last = last
+        self.records = []
+        self.rows = []
+        self.templates = None
+        self.local_tags = None
+        self.learned_tags = None
+        self.tagged = listing.cached is not None
+    
+    def __len__(self):
+        return len(self.entries)
+
+
+class PipelineStage:
+    """Стадия конвейера: свои потоки и входная очередь ограниченного размера
+    
+    При gather > 0 функция стадии получает список пакетов: поток добирает из
+    очереди уже готовые пакеты, пока в них не наберется gather файлов.
+    """
+    
+    def __init__(self, name, func=None, workers=1, queue_size=PIPELINE_QUEUE_SIZE, gather=0):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.gather = gather
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.running = self.workers
+        self.items = 0
+        self.files = 0
+        self.busy = 0.0
+        self.max_depth = 0
+    
+    def record(self, files, seconds, depth):
+        """Учесть обработанный пакет в статистике стадии"""
+        with self.lock:
+            self.items += 1
+            self.files += files
+            self.busy += seconds
+            self.max_depth = max(self.max_depth, depth)
+
+
+class ScanPipeline:
+    """Конвейер сканирования: обход → stat → локальные теги → OpenAI → приемник
+    
+    Очереди между стадиями ограничены, а число пакетов в работе ограничено
+    семафором, поэтому медленная стадия притормаживает обход, а не копит память.
+    Приемник получает пакеты в порядке обхода, как при последовательном сканировании.
+    """
+    
+    def __init__(self, source, stages, sink, max_in_flight=PIPELINE_QUEUE_SIZE * 4,
+                 cancelled=None, running=None):
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.walk_stage = PipelineStage('обход', queue_size=0)
+        self.sink_stage = PipelineStage('приемник', queue_size=0)
+        self.output = self.sink_stage.queue
+        self.pending = {}
+        self.in_flight = threading.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.stop = threading.Event()
+        # Отмена и пауза приходят снаружи: отмена завершает run() на уже готовых пакетах,
+        # пауза придерживает обход, а начатые пакеты доходят до приемника
+        self.cancelled = cancelled or threading.Event()
+        if running is None:
+            running = threading.Event()
+            running.set()
+        self.running = running
+        self.error = None
+        self.started = time.perf_counter()
+        self.elapsed = None
+    
+    def fail(self, error):
+        """Остановить конвейер, запомнив первую ошибку"""
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+    
+    def put(self, target, item):
+        """Положить пакет в очередь стадии; ждет место, пока конвейер не остановлен"""
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def next_queue(self, index):
+        return self.stages[index + 1].queue if index + 1 < len(self.stages) else self.output
+    
+    def run_source(self):
+        """Поток обхода: выдает пакеты, пока есть свободное место в конвейере"""
+        target = self.next_queue(-1)
+        batches = iter(self.source)
+        try:
+            while True:
+                while not self.running.wait(0.1):
+                    if self.stop.is_set():
+                        return
+                while not self.in_flight.acquire(timeout=0.1):
+                    if self.stop.is_set():
+                        return
+                started = time.perf_counter()
+                batch = next(batches, PIPELINE_DONE)
+                if batch is PIPELINE_DONE:
+                    self.in_flight.release()
+                    break
+                self.walk_stage.record(len(batch), time.perf_counter() - started,
+                                     self.walk_stage.items - self.sink_stage.items)
+                if not self.put(target, batch):
+                    return
+            self.put(target, PIPELINE_DONE)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            # Генератор обхода закрываем в своем потоке: это останавливает и потоки чтения папок
+            close = getattr(batches, 'close', None)
+            if close is not None:
+                close()
+    
+    def run_stage(self, index):
+        """Поток стадии: берет пакеты из своей очереди и передает следующей"""
+        stage = self.stages[index]
+        target = self.next_queue(index)
+        try:
+            while not self.stop.is_set():
+                try:
+                    batch = stage.queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                
+                if batch is PIPELINE_DONE:
+                    # Маркер конца возвращаем соседним потокам стадии,
+                    # дальше его передает последний завершившийся поток
+                    stage.queue.put(batch)
+                    with stage.lock:
+                        stage.running -= 1
+                        last = stage.running == 0
+                    if last:
+                        self.put(target, PIPELINE_DONE)
+                    return
+                
+                depth = stage.queue.qsize()
+                batches = [batch]
+                files = len(batch)
+                while files < stage.gather:
+                    try:
+                        batch = stage.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if batch is PIPELINE_DONE:
+                        stage.queue.put(batch)
+                        break
+                    batches.append(batch)
+                    files += len(batch)
+                
+                started = time.perf_counter()
+                stage.func(batches if stage.gather else batches[0])
+                stage.record(files, time.perf_counter() - started, depth)
+                for batch in batches:
+                    if not self.put(target, batch):
+                        return
+        except Exception as e:
+            self.fail(e)
+    
+    def run(self):
+        """Запустить стадии и выполнять приемник в текущем потоке до конца обхода"""
+        threads = [threading.Thread(target=self.run_source, daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads.extend(threading.Thread(target=self.run_stage, args=(index,), daemon=True)
+                           for _ in range(stage.workers))
+        self.started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        
+        next_seq = 0
+        try:
+            while not self.cancelled.is_set():
+                if self.error is not None:
+                    raise self.error
+                try:
+                    batch = self.output.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if batch is PIPELINE_DONE:
+                    break
+                
+                self.pending[batch.seq] = batch
+                depth = self.output.qsize() + len(self.pending)
+                while next_seq in self.pending:
+                    batch = self.pending.pop(next_seq)
+                    started = time.perf_counter()
+                    self.sink(batch)
+                    self.sink_stage.record(len(batch), time.perf_counter() - started, depth)
+                    self.in_flight.release()
+                    next_seq += 1
+            
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.stop.set()
+            self.elapsed = time.perf_counter() - self.started
+    
+    def stage_stats(self):
+        """Состояние стадий: глубина очереди, файлы, скорость и занятость потоков"""
+        elapsed = self.elapsed or time.perf_counter() - self.started
+        elapsed = max(elapsed, 1e-9)
+        stats = []
+        for stage in [self.walk_stage] + self.stages + [self.sink_stage]:
+            if stage is self.sink_stage:
+                depth, capacity = self.output.qsize() + len(self.pending), self.max_in_flight
+            elif stage is self.walk_stage:
+                depth, capacity = self.walk_stage.items - self.sink_stage.items, self.max_in_flight
+            else:
+                depth, capacity = stage.queue.qsize(), stage.queue.maxsize
+            stats.append({
+                'name': stage.name,
+                'workers': stage.workers,
+                'queue': depth,
+                'capacity': capacity,
+                'max_queue': stage.max_depth,
+                'files': stage.files,
+                'rate': stage.files / elapsed,
+                'busy': min(stage.busy / (elapsed * stage.workers), 1.0)
+            })
+        return stats
+    
+    def bottleneck(self):
+        """Стадия с наибольшей занятостью потоков"""
+        return max(self.stage_stats(), key=lambda stats: stats['busy'])['name']
+    
+    def status_text(self):
+        """Короткая строка для строки прогресса: очереди стадий"""
+        return ' · '.join(f"{stats['name']} {stats['queue']}/{stats['capacity']}"
+                          for stats in self.stage_stats()[1:])
+    
+    def print_report(self):
+        """Вывести в консоль сводку по стадиям"""
+        print(f"📊 Конвейер сканирования ({self.elapsed or 0:.2f} с):")
+        for stats in self.stage_stats():
+            print(f"   {stats['name']:<10} потоков {stats['workers']:>2}  "
+                  f"очередь макс {stats['max_queue']:>3}  файлов {stats['files']:>8}  "
+                  f"{stats['rate']:>9.0f} ф/с  занятость {stats['busy'] * 100:>3.0f}%")
+        print(f"   🐢 Узкое место: {self.bottleneck()}")
+
+
+NAME_DATE_PATTERN = re.compile(r'(?<!\d)(?:19|20)\d\d[-_.]?(?:0[1-9]|1[0-2])[-_.]?(?:0[1-9]|[12]\d|3[01])(?!\d)')
+NAME_NUMBER_PATTERN = re.compile(r'\d+')
+
+
+def name_template(name):
+    """Шаблон имени: даты и числа заменены заполнителями (IMG_0001.jpg -> img_#.jpg)"""
+    return NAME_NUMBER_PATTERN.sub('#', NAME_DATE_PATTERN.sub('{дата}', name.lower()))
+
+
+class SearchIndex:
+    """Индекс поиска: триграммы имен, точные теги и папки -> позиции файлов в view()
+    
+    Пополняется при сканировании. Одинаковые имена (index.html, __init__.py) хранятся
+    один раз, триграммы строятся только для новых имен. Кандидаты берутся по самой
+    редкой триграмме запроса и проверяются по имени, поэтому поиск не перебирает
+    все файлы (кроме запросов короче трех символов).
+    """
+    
+    def __init__(self, dirs):
+        self.dirs = dirs
+        self.lock = threading.Lock()
+        self.names = []
+        self.name_ids = {}
+        self.first_files = array('I')
+        self.more_files = {}
+        self.file_names = array('I')
+        self.grams = {}
+        self.tags = {}
+        self.dir_files = {}
+        self.dir_paths = {}
+    
+    def __len__(self):
+        return len(self.file_names)
+    
+    def add(self, name, dir_id, tags):
+        with self.lock:
+            self.add_unlocked(name, dir_id, tags)
+    
+    def extend(self, rows):
+        """Добавить (имя, id папки, теги) пачкой, например для открытого с диска сканирования"""
+        with self.lock:
+            for name, dir_id, tags in rows:
+                self.add_unlocked(name, dir_id, tags)
+    
+    def add_unlocked(self, name, dir_id, tags):
+        position = len(self.file_names)
+        name = name.lower()
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            self.first_files.append(position)
+            grams = self.grams
+            for gram in {name[i:i + 3] for i in range(len(name) - 2)}:
+                postings = grams.get(gram)
+                if postings is None:
+                    postings = grams[gram] = array('I')
+                postings.append(name_id)
+        else:
+            postings = self.more_files.get(name_id)
+            if postings is None:
+                postings = self.more_files[name_id] = array('I')
+            postings.append(position)
+        self.file_names.append(name_id)
+        
+        for tag in tags:
+            tag = tag.lower()
+            postings = self.tags.get(tag)
+            if postings is None:
+                postings = self.tags[tag] = array('I')
+            postings.append(position)
+        
+        postings = self.dir_files.get(dir_id)
+        if postings is None:
+            postings = self.dir_files[dir_id] = array('I')
+            path = self.dirs.path(dir_id).lower()
+            self.dir_paths[dir_id] = path if path.endswith(os.sep) else path + os.sep
+        postings.append(position)
+    
+    def search(self, query):
+        """Позиции по возрастанию для файлов, подходящих под все слова запроса
+        
+        #тег - точный тег, path:текст - часть полного пути, текст* - начало имени,
+        остальные слова - часть имени или тега.
+        """
+        conditions = []
+        with self.lock:
+            for term in query.lower().split():
+                if term.startswith('#') and len(term) > 1:
+                    matched = self.tags.get(term[1:], ())
+                elif term.startswith('path:') and len(term) > 5:
+                    matched = self.path_matches(term[5:])
+                elif term.endswith('*') and len(term) > 1:
+                    matched = self.name_matches(term[:-1], prefix=True)
+                else:
+                    matched = self.name_matches(term)
+                    tagged = [postings for tag, postings in self.tags.items() if term in tag]
+                    if tagged:
+                        matched = sorted(set(matched).union(*tagged))
+                conditions.append(matched)
+        
+        if not conditions:
+            return []
+        # Каждое условие уже упорядочено: остается пересечь их, начиная с самого короткого
+        conditions.sort(key=len)
+        found = list(conditions[0])
+        for matched in conditions[1:]:
+            if len(found) * 32 < len(matched):
+                found = [p for p in found if contains_sorted(matched, p)]
+            else:
+                matched = set(matched)
+                found = [p for p in found if p in matched]
+        return found
+    
+    def name_matches(self, text, prefix=False):
+        """Позиции файлов, имя которых содержит text (или начинается с него)"""
+        names = self.names
+        if len(text) >= 3:
+            candidates = []
+            for i in range(len(text) - 2):
+                postings = self.grams.get(text[i:i + 3])
+                if postings is None:
+                    return []
+                if not candidates or len(postings) < len(candidates):
+                    candidates = postings
+        else:
+            candidates = range(len(names))
+        if prefix:
+            name_ids = [n for n in candidates if names[n].startswith(text)]
+        else:
+            name_ids = [n for n in candidates if text in names[n]]
+        
+        # Первые файлы имен идут по возрастанию id имени; повторы имени добавляются отдельно
+        first_files = self.first_files
+        found = [first_files[n] for n in name_ids]
+        more_files = self.more_files
+        repeated = [more_files[n] for n in name_ids if n in more_files]
+        if repeated:
+            for positions in repeated:
+                found.extend(positions)
+            found.sort()
+        return found
+    
+    def path_matches(self, text):
+        """Полный путь содержит текст: целиком в пути папки, целиком в имени или на стыке"""
+        text = text.replace('/', os.sep)
+        head, sep, tail = text.rpartition(os.sep)
+        head += sep
+        names = self.names
+        file_names = self.file_names
+        matched = [] if sep else self.name_matches(text)
+        for dir_id, path in self.dir_paths.items():
+            if text in path:
+                matched.extend(self.dir_files[dir_id])
+            elif sep and path.endswith(head):
+                matched.extend(p for p in self.dir_files[dir_id] if names[file_names[p]].startswith(tail))
+        return sorted(set(matched))
+
+
+def contains_sorted(values, value):
+    """Есть ли value в упорядоченной последовательности (двоичный поиск)"""
+    index = bisect.bisect_left(values, value)
+    return index < len(values) and values[index] == value
+
+
+class RecordColumns:
+    """Колонки хранилища для фильтров: размер, время изменения и создания, расширение, папка
+    
+    Записи только добавляются, поэтому колонки дописываются перед каждым фильтром.
+    Массивы array отдаются в NumPy без копирования.
+    """
+    
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.sizes = array('q')
+        self.mtimes = array('d')
+        self.ctimes = array('d')
+        self.extension_codes = array('I')
+        self.extension_ids = {}
+        self.dir_ids = array('I')
+    
+    def __len__(self):
+        return len(self.sizes)
+    
+    def update(self):
+        """Дописать колонки для новых записей хранилища"""
+        extension_ids = self.extension_ids
+        for size, mtime, ctime, extension, dir_id in self.store.column_rows(len(self.sizes)):
+            extension = extension.lower()
+            code = extension_ids.get(extension)
+            if code is None:
+                code = extension_ids[extension] = len(extension_ids)
+            self.sizes.append(size)
+            self.mtimes.append(mtime)
+            self.ctimes.append(ctime)
+            self.extension_codes.append(code)
+            self.dir_ids.append(dir_id)
+
+
+class FileFilter:
+    """Составной фильтр файлов: должны выполняться все заданные условия
+    
+    Размер, время и расширение проверяются масками NumPy по RecordColumns (без NumPy -
+    циклом), теги - по индексу поиска, шаблон пути и регулярное выражение - только
+    для файлов, прошедших остальные условия.
+    """
+    
+    def __init__(self, min_size=None, max_size=None, extensions=(), modified=(None, None),
+                 created=(None, None), tags=(), exclude_tags=(), path_glob='', name_regex=''):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.extensions = {extension.lower() for extension in extensions}
+        self.modified = modified
+        self.created = created
+        self.tags = [tag.lower() for tag in tags]
+        self.exclude_tags = [tag.lower() for tag in exclude_tags]
+        # Шаблон без разделителя проверяется по имени (как find -name), с разделителем - по пути
+        self.path_glob = path_glob.lower().replace('/', os.sep)
+        self.glob_regex = re.compile(fnmatch.translate(self.path_glob)) if path_glob else None
+        self.name_regex = re.compile(name_regex, re.IGNORECASE) if name_regex else None
+    
+    def uses_index(self):
+        """Нужен ли индекс поиска (теги, имена и пути)"""
+        return bool(self.tags or self.exclude_tags or self.glob_regex or self.name_regex)
+    
+    def describe(self):
+        parts = []
+        if self.min_size is not None or self.max_size is not None:
+            low = f"{self.min_size / (1024 * 1024):g}" if self.min_size is not None else "0"
+            high = f"{self.max_size / (1024 * 1024):g}" if self.max_size is not None else "∞"
+            parts.append(f"размер {low}-{high} MB")
+        if self.extensions:
+            parts.append("расширения: " + ", ".join(sorted(self.extensions)))
+        for label, (start, end) in (("изменен", self.modified), ("создан", self.created)):
+            if start is not None or end is not None:
+                start_text = datetime.fromtimestamp(start).strftime('%Y-%m-%d') if start is not None else "…"
+                end_text = datetime.fromtimestamp(end - 1).strftime('%Y-%m-%d') if end is not None else "…"
+                parts.append(f"{label} {start_text} - {end_text}")
+        if self.tags:
+            parts.append("теги: " + ", ".join(self.tags))
+        if self.exclude_tags:
+            parts.append("без тегов: " + ", ".join(self.exclude_tags))
+        if self.glob_regex:
+            parts.append(f"путь: {self.path_glob}")
+        if self.name_regex:
+            parts.append(f"имя ~ {self.name_regex.pattern}")
+        return ", ".join(parts) or "без условий"
+    
+    def ranges(self, columns):
+        """(колонка, от, до, включается ли до): размер до включительно, время - до начала дня"""
+        return [(columns.sizes, self.min_size, self.max_size, True),
+                (columns.mtimes, self.modified[0], self.modified[1], False),
+                (columns.ctimes, self.created[0], self.created[1], False)]
+    
+    def apply(self, columns, index, count):
+        """Позиции первых count файлов, подходящих под фильтр, по возрастанию"""
+        extension_codes = [columns.extension_ids[extension] for extension in self.extensions
+                           if extension in columns.extension_ids]
+        if self.extensions and not extension_codes:
+            return []
+        if np is not None:
+            positions = self.mask_positions(columns, index, count, extension_codes)
+        else:
+            positions = self.loop_positions(columns, index, count, extension_codes)
+        
+        if self.glob_regex is None and self.name_regex is None:
+            return positions
+        if not isinstance(positions, list):
+            positions = positions.tolist()
+        names = index.names
+        file_names = index.file_names
+        by_path = self.glob_regex is not None and os.sep in self.path_glob
+        # Одинаковые имена проверяются один раз
+        checked = {}
+        found = []
+        for position in positions:
+            name_id = file_names[position]
+            matched = checked.get(name_id)
+            if matched is None:
+                name = names[name_id]
+                matched = checked[name_id] = (
+                    (self.name_regex is None or self.name_regex.search(name) is not None) and
+                    (self.glob_regex is None or by_path or self.glob_regex.match(name) is not None))
+            if matched and by_path:
+                path = index.dir_paths[columns.dir_ids[position]] + names[name_id]
+                matched = self.glob_regex.match(path) is not None
+            if matched:
+                found.append(position)
+        return found
+    
+    def mask_positions(self, columns, index, count, extension_codes):
+        mask = np.ones(count, dtype=bool)
+        for values, low, high, inclusive in self.ranges(columns):
+            if low is None and high is None:
+                continue
+            column = np.frombuffer(values, dtype=np.int64 if values.typecode == 'q' else np.float64, count=count)
+            if low is not None:
+                mask &= column >= low
+            if high is not None:
+                mask &= (column <= high) if inclusive else (column < high)
+        if self.extensions:
+            # Таблица "код расширения -> подходит" быстрее np.isin: один проход без сортировки
+            allowed = np.zeros(len(columns.extension_ids), dtype=bool)
+            allowed[extension_codes] = True
+            mask &= allowed[np.frombuffer(columns.extension_codes, dtype=np.uint32, count=count)]
+        
+        # Позиции тегов копируются под замком: сканирование может дописывать их прямо сейчас
+        with index.lock:
+            tag_positions = [np.frombuffer(index.tags.get(tag, array('I')), dtype=np.uint32).copy()
+                             for tag in self.tags]
+            excluded_positions = [np.frombuffer(index.tags.get(tag, array('I')), dtype=np.uint32).copy()
+                                  for tag in self.exclude_tags]
+        for positions in tag_positions:
+            tagged = np.zeros(count, dtype=bool)
+            tagged[positions[positions < count]] = True
+            mask &= tagged
+        for positions in excluded_positions:
+            mask[positions[positions < count]] = False
+        return np.flatnonzero(mask)
+    
+    def loop_positions(self, columns, index, count, extension_codes):
+        positions = range(count)
+        for values, low, high, inclusive in self.ranges(columns):
+            if low is not None:
+                positions = [p for p in positions if values[p] >= low]
+            if high is not None:
+                positions = [p for p in positions if (values[p] <= high if inclusive else values[p] < high)]
+        if self.extensions:
+            codes = set(extension_codes)
+            positions = [p for p in positions if columns.extension_codes[p] in codes]
+        with index.lock:
+            for tag in self.tags:
+                tagged = set(index.tags.get(tag, ()))
+                positions = [p for p in positions if p in tagged]
+            for tag in self.exclude_tags:
+                tagged = set(index.tags.get(tag, ()))
+                positions = [p for p in positions if p not in tagged]
+        return list(positions)
+
+
+class ScanStore:
+    """Результаты сканирования в памяти (по умолчанию)"""
+    
+    def __init__(self, scanned_folder=None):
+        self.records = []
+        self.scanned_folder = scanned_folder
+        self.dirs = DirectoryTable(scanned_folder or '')
+        self.templates = Counter()
+        self.sort_cache = SortCache(self)
+        self.search_index = SearchIndex(self.dirs)
+        self.columns = RecordColumns(self)
+    
+    def append(self, file_info):
+        # Индекс пополняется первым: поиск во время сканирования отбрасывает лишние позиции
+        self.search_index.add(file_info.name, file_info.dir_id, file_info.ai_tags)
+        self.records.append(file_info)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        pass
+    
+    def __len__(self):
+        return len(self.records)
+    
+    def __iter__(self):
+        return iter(self.records)
+    
+    def view(self):
+        """Элементы для таблицы результатов (здесь сами записи, без копирования)"""
+        return self.records
+    
+    def fetch(self, items):
+        """Записи для элементов view() - в памяти это те же объекты"""
+        return items
+    
+    def sorted_view(self, column, reverse=False, positions=None):
+        """view() или его позиции positions, упорядоченные по колонке таблицы"""
+        return self.sort_cache.view(column, reverse, positions)
+    
+    def sort_keys(self, column, start=0):
+        """Ключи сортировки колонки для элементов view()[start:]"""
+        return [RECORD_SORT_KEYS[column](file_info) for file_info in self.records[start:]]
+    
+    def search(self, query):
+        """Позиции view() файлов под запрос: часть имени или AI тега, см. SearchIndex.search"""
+        count = len(self)
+        found = self.search_index.search(query)
+        # Индекс пополняется раньше хранилища: файл, добавляемый прямо сейчас, не показываем
+        del found[bisect.bisect_left(found, count):]
+        return found
+    
+    def update_search_index(self, chunk=10000):
+        """Дописать в индекс поиска недостающие файлы (сканирование, открытое с диска)"""
+        index = self.search_index
+        while len(index) < len(self):
+            index.extend(self.index_rows(len(index), chunk))
+    
+    def index_rows(self, start, limit):
+        """(имя, id папки, теги) файлов view()[start:start + limit] для индекса поиска"""
+        return [(file_info.name, file_info.dir_id, file_info.ai_tags)
+                for file_info in self.records[start:start + limit]]
+    
+    def filter(self, file_filter):
+        """Позиции view() файлов под фильтр (FileFilter) и число файлов, среди которых искали
+        
+        Условия по тегам, именам и путям проверяются только среди уже проиндексированных
+        файлов (индекс открытого с диска сканирования строится в фоне).
+        """
+        columns = self.columns
+        with columns.lock:
+            columns.update()
+            count = len(columns)
+            if file_filter.uses_index():
+                count = min(count, len(self.search_index))
+            return file_filter.apply(columns, self.search_index, count), count
+    
+    def column_rows(self, start=0):
+        """(размер, mtime, ctime, расширение, id папки) файлов view()[start:] для колонок фильтра"""
+        return [(file_info.size_bytes, file_info.mtime, file_info.ctime, file_info.extension, file_info.dir_id)
+                for file_info in self.records[start:]]
+    
+    def record(self, position):
+        """Запись по позиции в view() - ее постоянному id (записи только добавляются)"""
+        return self.records[position]
+    
+    def by_size(self, limit=None):
+        """Файлы от больших к меньшим"""
+        ordered = sorted(self, key=lambda x: x.size_bytes, reverse=True)
+        return ordered[:limit] if limit is not None else ordered
+    
+    def total_size_mb(self):
+        return sum(f.size_bytes for f in self) / (1024 * 1024)
+    
+    def extension_stats(self):
+        """Количество файлов по расширениям"""
+        extensions = {}
+        for file_info in self:
+            ext = file_info.extension
+            extensions[ext] = extensions.get(ext, 0) + 1
+        return extensions
+    
+    def template_stats(self):
+        """Размеры семейств файлов по шаблону имени (при сканировании считаются конвейером)"""
+        if not self.templates and len(self):
+            self.templates = Counter(name_template(file_info.name) for file_info in self)
+        return self.templates
+    
+    def directory_files(self):
+        """Размер и число файлов, лежащих непосредственно в каждой папке"""
+        sizes = [0] * len(self.dirs)
+        counts = [0] * len(self.dirs)
+        for file_info in self:
+            sizes[file_info.dir_id] += file_info.size_bytes
+            counts[file_info.dir_id] += 1
+        return sizes, counts
+    
+    def directory_totals(self):
+        """Размер и число файлов по папкам вместе с подпапками"""
+        sizes, counts = self.directory_files()
+        parents = self.dirs.parents
+        # Потомки добавлены позже родителей, поэтому хватает одного прохода с конца
+        for dir_id in range(len(sizes) - 1, 0, -1):
+            parent_id = parents[dir_id]
+            sizes[parent_id] += sizes[dir_id]
+            counts[parent_id] += counts[dir_id]
+        return sizes, counts
+
+
+class SQLiteScanStore(ScanStore):
+    """Результаты сканирования в SQLite: переживают перезапуск, поиск и фильтры идут запросами"""
+    
+    BATCH_SIZE = 2000
+    SCHEMA_VERSION = 3
+    COLUMNS = ('name', 'dir_id', 'extension', 'size_bytes', 'mtime', 'ctime', 'ai_tags')
+    
+    def __init__(self, path, scanned_folder=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.pending = []
+        self.templates = Counter()
+        self.sort_cache = SortCache(self)
+        
+        if scanned_folder is not None:
+            for stale_path in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+        
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        has_files = self.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'files'").fetchone()[0]
+        if has_files and version != self.SCHEMA_VERSION:
+            self.conn.close()
+            raise sqlite3.DatabaseError("хранилище создано другой версией программы, пересканируйте папку")
+        self.conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS scan_info (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS dirs (
+                id INTEGER PRIMARY KEY, parent_id INTEGER, name TEXT)''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                name TEXT, dir_id INTEGER, extension TEXT,
+                size_bytes INTEGER, mtime REAL, ctime REAL, ai_tags TEXT, search_text TEXT)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_extension ON files(extension, size_bytes)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_size ON files(size_bytes)')
+            if scanned_folder is not None:
+                self.conn.executemany('INSERT OR REPLACE INTO scan_info VALUES (?, ?)', [
+                    ('scanned_folder', scanned_folder),
+                    ('date', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                ])
+        
+        row = self.conn.execute("SELECT value FROM scan_info WHERE key = 'scanned_folder'").fetchone()
+        self.scanned_folder = row[0] if row else None
+        self.count = self.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        
+        self.dirs = DirectoryTable(self.scanned_folder or '')
+        for dir_id, parent_id, name in self.conn.execute('SELECT id, parent_id, name FROM dirs WHERE id > 0 ORDER BY id'):
+            self.dirs.add(parent_id, name)
+        self.dirs_saved = self.conn.execute('SELECT COUNT(*) FROM dirs').fetchone()[0]
+        # Для открытого с диска сканирования индекс поиска строится в фоне (update_search_index)
+        self.search_index = SearchIndex(self.dirs)
+        self.columns = RecordColumns(self)
+    
+    def append(self, file_info):
+        tags = file_info.ai_tags
+        self.search_index.add(file_info.name, file_info.dir_id, tags)
+        search_text = (file_info.name + '\n' + ' '.join(tags)).lower()
+        row = tuple(getattr(file_info, column) for column in self.COLUMNS[:-1])
+        with self.lock:
+            self.pending.append(row + (json.dumps(tags, ensure_ascii=False), search_text))
+            self.count += 1
+            if len(self.pending) >= self.BATCH_SIZE:
+                self.flush()
+    
+    def flush(self):
+        """Записать накопленные записи (и новые папки) одной транзакцией"""
+        with self.lock:
+            dirs_total = len(self.dirs)
+            if not self.pending and self.dirs_saved == dirs_total:
+                return
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT INTO dirs (id, parent_id, name) VALUES (?, ?, ?)',
+                    ((dir_id, self.dirs.parents[dir_id], self.dirs.names[dir_id])
+                     for dir_id in range(self.dirs_saved, dirs_total)))
+                self.conn.executemany(
+                    'INSERT INTO files (name, dir_id, extension, size_bytes, mtime, ctime, ai_tags, search_text) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self.pending)
+            self.dirs_saved = dirs_total
+            self.pending = []
+    
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+    
+    def __len__(self):
+        return self.count
+    
+    def row_to_info(self, row):
+        return FileRecord(row[0], self.dirs, *row[1:-1], ai_tags=json.loads(row[-1] or '[]'))
+    
+    def query(self, where='', params=(), order='id', limit=None):
+        """Записи по условию; строки читаются порциями, а не все сразу"""
+        self.flush()
+        columns = ', '.join(self.COLUMNS)
+        sql = f'SELECT {columns} FROM files'
+        if where:
+            sql += f' WHERE {where}'
+        sql += f' ORDER BY {order}'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield self.row_to_info(row)
+    
+    def __iter__(self):
+        return self.query()
+    
+    def view(self):
+        """id строк: таблица читает записи только для видимого окна
+        
+        Строки только добавляются, поэтому id идут подряд с 1 и список не нужен.
+        """
+        return range(1, self.count + 1)
+    
+    def fetch(self, ids):
+        """Записи по id в порядке ids"""
+        if not ids:
+            return []
+        columns = ', '.join(self.COLUMNS)
+        with self.lock:
+            # Видимое окно может прийтись на еще не записанные строки идущего сканирования
+            self.flush()
+            rows = self.conn.execute(f'SELECT id, {columns} FROM files WHERE id IN ({", ".join("?" * len(ids))})',
+                                     list(ids)).fetchall()
+        records = {row[0]: self.row_to_info(row[1:]) for row in rows}
+        return [records[row_id] for row_id in ids if row_id in records]
+    
+    def sort_keys(self, column, start=0):
+        """Ключи сортировки колонки для строк с id больше start, в порядке id"""
+        self.flush()
+        fields = {'name': 'name', 'path': 'dir_id, name', 'size': 'size_bytes',
+                  'extension': 'extension', 'modified': 'mtime', 'tags': 'ai_tags'}[column]
+        with self.lock:
+            rows = self.conn.execute(f'SELECT {fields} FROM files WHERE id > ? ORDER BY id', (start,)).fetchall()
+        
+        # Строки сравниваются как в Python (lower() в SQLite не знает кириллицу)
+        if column in ('size', 'modified'):
+            return [row[0] for row in rows]
+        if column == 'path':
+            dir_paths = {}
+            keys = []
+            for dir_id, name in rows:
+                directory = dir_paths.get(dir_id)
+                if directory is None:
+                    directory = dir_paths[dir_id] = self.dirs.path(dir_id)
+                keys.append(os.path.join(directory, name).lower())
+            return keys
+        if column == 'tags':
+            return [', '.join(json.loads(row[0] or '[]')) for row in rows]
+        return [row[0].lower() for row in rows]
+    
+    def index_rows(self, start, limit):
+        self.flush()
+        with self.lock:
+            rows = self.conn.execute('SELECT name, dir_id, ai_tags FROM files WHERE id > ? ORDER BY id LIMIT ?',
+                                     (start, limit)).fetchall()
+        return [(name, dir_id, json.loads(tags or '[]')) for name, dir_id, tags in rows]
+    
+    def column_rows(self, start=0):
+        self.flush()
+        with self.lock:
+            return self.conn.execute('SELECT size_bytes, mtime, ctime, extension, dir_id FROM files '
+                                     'WHERE id > ? ORDER BY id', (start,)).fetchall()
+    
+    def record(self, position):
+        records = self.fetch([position + 1])
+        return records[0] if records else None
+    
+    def by_size(self, limit=None):
+        return list(self.query(order='size_bytes DESC', limit=limit))
+    
+    def total_size_mb(self):
+        self.flush()
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM files').fetchone()[0] / (1024 * 1024)
+    
+    def extension_stats(self):
+        self.flush()
+        with self.lock:
+            rows = self.conn.execute('SELECT extension, COUNT(*) FROM files GROUP BY extension').fetchall()
+        return dict(rows)
+    
+    def directory_files(self):
+        self.flush()
+        sizes = [0] * len(self.dirs)
+        counts = [0] * len(self.dirs)
+        with self.lock:
+            rows = self.conn.execute('SELECT dir_id, SUM(size_bytes), COUNT(*) FROM files GROUP BY dir_id').fetchall()
+        for dir_id, size, count in rows:
+            sizes[dir_id] = size
+            counts[dir_id] = count
+        return sizes, counts
+
+
+OPENAI_BASE_URL = 'https://api.openai.com/v1'
+OPENAI_BATCH_FILES = 50
+OPENAI_BATCH_TOKENS = 3000
+OPENAI_TOKENS_PER_FILE = 30
+OPENAI_PROMPT_VERSION = 1
+OPENAI_PRICE_PER_1K = 0.0015
+OPENAI_RETRIES = 2
+OPENAI_BACKOFF = 1.0
+OPENAI_BACKOFF_MAX = 30.0
+LEARNED_MIN_EXAMPLES = 200
+
+# Теги, которые ставятся любому файлу: по ним одним содержимое не понять
+GENERIC_TAGS = {'большой', 'средний', 'маленький', 'новый', 'недавний', 'старый'}
+DOCUMENT_EXTENSIONS = {'.pdf', '.doc', '.docx', '.txt', '.rtf', '.odt', '.xls', '.xlsx', '.ppt', '.pptx'}
+PROJECT_TAGS = {'код', 'программирование', 'разработка'}
+
+OPENAI_BATCH_PROMPT = """Проанализируй файлы и для каждого создай до 5 коротких тегов на русском языке.
+Теги описывают тип контента (документ, изображение, код, etc.), назначение (работа, личное, учеба, etc.) и особенности (большой, важный, etc.).
+
+Файлы (номер | имя | расширение | размер MB):
+{files}
+
+Ответ только JSON объект без пояснений, ключ - номер файла: {{"1": ["тег", "тег"], "2": ["тег"]}}"""
+
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов (кириллица и имена файлов - около 3 символов на токен)"""
+    return len(text) // 3 + 1
+
+
+def parse_batch_tags(content, count):
+    """Теги по номерам файлов из JSON ответа; None для файлов, которых в ответе нет"""
+    start, end = content.find('{'), content.rfind('}')
+    if start < 0 or end < start:
+        return [None] * count
+    try:
+        data = json.loads(content[start:end + 1])
+    except ValueError:
+        return [None] * count
+    if not isinstance(data, dict):
+        return [None] * count
+    
+    result = []
+    for number in range(1, count + 1):
+        tags = data.get(str(number))
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        if not isinstance(tags, list):
+            result.append(None)
+            continue
+        result.append([str(tag).strip() for tag in tags if str(tag).strip()][:5])
+    return result
+
+
+class OpenAIError(Exception):
+    """Ошибка ответа OpenAI API"""
+    
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class OpenAIClient:
+    """Клиент OpenAI: пул постоянных соединений, лимит запросов в полете и лимиты из заголовков"""
+    
+    TIMEOUT = (5, 60)
+    TOKENS_PER_REQUEST = 300
+    
+    def __init__(self, api_key, base_url=OPENAI_BASE_URL, max_in_flight=4):
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.max_in_flight = max(1, max_in_flight)
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        })
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.requests_sent = 0
+        self.rate_limited = 0
+    
+    @staticmethod
+    def parse_duration(value):
+        """Секунды из retry-after ('2') или x-ratelimit-reset-* ('1s', '6m0s', '20ms')"""
+        if not value:
+            return 0.0
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+        return sum(float(amount) * units[unit] for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value))
+    
+    def wait_for_limits(self):
+        """Подождать, если сервер попросил паузу"""
+        while True:
+            with self.lock:
+                delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(min(delay, 1.0))
+    
+    def update_limits(self, response):
+        """Поставить общую паузу, если лимит запросов или токенов исчерпан"""
+        headers = response.headers
+        delay = 0.0
+        if response.status_code == 429:
+            delay = (self.parse_duration(headers.get('retry-after')) or
+                     max(self.parse_duration(headers.get('x-ratelimit-reset-requests')),
+                         self.parse_duration(headers.get('x-ratelimit-reset-tokens'))) or 1.0)
+        else:
+            # Остальные запросы в полете тоже потратят лимит, поэтому тормозим заранее
+            for kind, reserve in (('requests', self.max_in_flight),
+                                  ('tokens', self.max_in_flight * self.TOKENS_PER_REQUEST)):
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                if remaining is not None and remaining.isdigit() and int(remaining) < reserve:
+                    delay = max(delay, self.parse_duration(headers.get(f'x-ratelimit-reset-{kind}')))
+        if delay > 0:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+    
+    def chat(self, model, prompt, max_tokens=100, temperature=0.3, timeout=None):
+        """Запрос chat/completions: ChatReply (текст, израсходовано токенов, причина остановки)"""
+        data = {
+            'model': model,
+            'messages': [{'role': 'user', 'content': prompt}],
+            'max_tokens': max_tokens,
+            'temperature': temperature
+        }
+        
+        for attempt in range(2):
+            self.wait_for_limits()
+            with self.slots:
+                response = self.session.post(self.url, json=data, timeout=timeout or self.TIMEOUT)
+            with self.lock:
+                self.requests_sent += 1
+            self.update_limits(response)
+            # На 429 один повтор после паузы из заголовков
+            if response.status_code != 429:
+                break
+            with self.lock:
+                self.rate_limited += 1
+        
+        if response.status_code != 200:
+            raise OpenAIError(f"{response.status_code} - {response.text}", response.status_code)
+        result = response.json()
+        choice = result['choices'][0]
+        return ChatReply(choice['message']['content'].strip(),
+                         result.get('usage', {}).get('total_tokens', 0),
+                         choice.get('finish_reason'))
+    
+    def close(self):
+        self.session.close()
+
+
+class TagCache:
+    """Кэш тегов OpenAI на диске (SQLite) с вытеснением давно не использованных записей"""
+    
+    FLUSH_SIZE = 1000
+    
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self.dirty = set()
+        self.evicted = []
+        
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS tags (key TEXT PRIMARY KEY, tags TEXT, last_used INTEGER)')
+        # Порядок OrderedDict - порядок использования: в начале самые старые записи
+        self.entries = OrderedDict(
+            (key, json.loads(tags))
+            for key, tags in self.conn.execute('SELECT key, tags FROM tags ORDER BY last_used'))
+        row = self.conn.execute('SELECT MAX(last_used) FROM tags').fetchone()
+        self.clock = row[0] or 0
+        self.evict()
+    
+    @staticmethod
+    def key(file_info, model):
+        """Ключ: модель, версия промпта, расширение, порядок размера и нормализованное имя"""
+        name = ' '.join(file_info.name.lower().split())
+        size_bucket = int(file_info.size_bytes).bit_length()
+        return f"{model}|v{OPENAI_PROMPT_VERSION}|{file_info.extension.lower()}|{size_bucket}|{name}"
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get(self, key):
+        with self.lock:
+            tags = self.entries.get(key)
+            if tags is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            self.touch(key)
+            return tags
+    
+    def put(self, key, tags):
+        with self.lock:
+            self.version += 1
+            self.entries[key] = tags
+            self.entries.move_to_end(key)
+            self.touch(key)
+            self.evict()
+    
+    def examples(self, model):
+        """Обучающие примеры для TagClassifier: (имя, расширение, порядок размера, теги)"""
+        prefix = f"{model}|v{OPENAI_PROMPT_VERSION}|"
+        with self.lock:
+            items = list(self.entries.items())
+        result = []
+        for key, tags in items:
+            if not key.startswith(prefix):
+                continue
+            _, _, extension, size_bucket, name = key.split('|', 4)
+            result.append((name, extension, int(size_bucket), tags))
+        return result
+    
+    def touch(self, key):
+        """Отметить запись для записи на диск; сброс пачками по FLUSH_SIZE"""
+        self.dirty.add(key)
+        if len(self.dirty) >= self.FLUSH_SIZE:
+            self.flush()
+    
+    def evict(self):
+        """Удалить самые старые записи сверх max_entries"""
+        with self.lock:
+            while len(self.entries) > self.max_entries:
+                key, _ = self.entries.popitem(last=False)
+                self.dirty.discard(key)
+                self.evicted.append(key)
+    
+    def flush(self):
+        """Записать использованные и новые записи одной транзакцией"""
+        with self.lock:
+            if not self.dirty and not self.evicted:
+                return
+            rows = []
+            # Счетчик last_used растет в порядке OrderedDict, поэтому при загрузке порядок LRU сохраняется
+            for key in reversed(self.entries):
+                if not self.dirty:
+                    break
+                if key in self.dirty:
+                    self.dirty.discard(key)
+                    rows.append(key)
+            rows.reverse()
+            with self.conn:
+                self.conn.executemany('DELETE FROM tags WHERE key = ?', ((key,) for key in self.evicted))
+                self.conn.executemany('INSERT OR REPLACE INTO tags VALUES (?, ?, ?)', (
+                    (key, json.dumps(self.entries[key], ensure_ascii=False), self.clock + index + 1)
+                    for index, key in enumerate(rows)))
+            self.clock += len(rows)
+            self.dirty = set()
+            self.evicted = []
+    
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+            self.dirty = set()
+            self.evicted = []
+            self.hits = 0
+            self.misses = 0
+            with self.conn:
+                self.conn.execute('DELETE FROM tags')
+            self.conn.execute('VACUUM')
+    
+    def size_mb(self):
+        try:
+            return os.path.getsize(self.path) / (1024 * 1024)
+        except OSError:
+            return 0.0
+    
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+
+CLASSIFIER_WORD_PATTERN = re.compile(r'[^\W\d_]{2,}')
+
+
+class TagClassifier:
+    """Наивный байесовский классификатор тегов по словам имени, расширению и размеру
+    
+    Обучается на ответах OpenAI из кэша. Для каждого тега решается, есть он у файла
+    или нет; веса хранятся разреженно - только для пар слово/тег, встречавшихся вместе.
+    """
+    
+    ALPHA = 0.5
+    COMMON_TAG_SHARE = 0.2
+    MEMO_SIZE = 100000
+    
+    def __init__(self):
+        self.examples = 0
+        self.tags = []
+        self.bias = {}
+        self.unseen = {}
+        self.feature_base = {}
+        self.deltas = {}
+        self.common_tags = []
+        self.memo = {}
+    
+    @staticmethod
+    def features(name, extension, size_bucket):
+        """Слова имени без цифр, расширение и порядок размера"""
+        name = name.lower()
+        extension = extension.lower()
+        end = len(name) - len(extension) if name.endswith(extension) else len(name)
+        words = CLASSIFIER_WORD_PATTERN.findall(name, 0, end)
+        words.append('ext:' + extension)
+        words.append(f'size:{size_bucket}')
+        return words
+    
+    def train(self, examples):
+        """Обучить на (имя, расширение, порядок размера, теги)"""
+        # Одинаковые после отбрасывания цифр имена считаются один раз с весом
+        groups = Counter((tuple(self.features(name, extension, size_bucket)), tuple(sorted(set(tags))))
+                         for name, extension, size_bucket, tags in examples)
+        pair_counts = Counter()
+        feature_counts = Counter()
+        tag_files = Counter()
+        tag_tokens = Counter()
+        files = 0
+        total_tokens = 0
+        for (features, tags), weight in groups.items():
+            files += weight
+            total_tokens += len(features) * weight
+            for feature in features:
+                feature_counts[feature] += weight
+                for tag in tags:
+                    pair_counts[feature, tag] += weight
+            for tag in tags:
+                tag_files[tag] += weight
+                tag_tokens[tag] += len(features) * weight
+        
+        alpha = self.ALPHA
+        vocabulary = len(feature_counts) or 1
+        self.examples = files
+        self.tags = list(tag_files)
+        # Слагаемые логарифма отношения правдоподобий P(f|t) / P(f|не t) разложены так,
+        # что для невстречавшейся пары (f, t) вес равен unseen[t] - feature_base[f]
+        self.feature_base = {feature: math.log(count + alpha) for feature, count in feature_counts.items()}
+        self.bias = {}
+        self.unseen = {}
+        for tag, count in tag_files.items():
+            with_tag = tag_tokens[tag] + alpha * vocabulary
+            without_tag = total_tokens - tag_tokens[tag] + alpha * vocabulary
+            self.bias[tag] = math.log(count + 1) - math.log(files - count + 1)
+            self.unseen[tag] = math.log(alpha) - math.log(with_tag) + math.log(without_tag)
+        
+        self.deltas = {}
+        log_alpha = math.log(alpha)
+        for (feature, tag), count in pair_counts.items():
+            seen = math.log(count + alpha) - math.log(feature_counts[feature] - count + alpha)
+            unseen = log_alpha - self.feature_base[feature]
+            self.deltas.setdefault(feature, {})[tag] = seen - unseen
+        self.common_tags = [tag for tag, count in tag_files.items() if count >= files * self.COMMON_TAG_SHARE]
+        self.memo = {}
+        return self
+    
+    def predict(self, name, extension, size_bucket):
+        """(теги, уверенность): теги с вероятностью от 0.5, уверенность - вероятность самого слабого"""
+        if not self.examples:
+            return [], 0.0
+        
+        features = tuple(self.features(name, extension, size_bucket))
+        result = self.memo.get(features)
+        if result is None:
+            if len(self.memo) >= self.MEMO_SIZE:
+                self.memo.clear()
+            result = self.memo[features] = self.score(features)
+        return result
+    
+    def score(self, features):
+        """Посчитать предсказание для набора признаков без кэша"""
+        known = [feature for feature in features if feature in self.feature_base]
+        if not known:
+            return [], 0.0
+        base = -sum(self.feature_base[feature] for feature in known)
+        
+        scores = dict.fromkeys(self.common_tags, 0.0)
+        for feature in known:
+            deltas = self.deltas.get(feature)
+            if deltas:
+                for tag, delta in deltas.items():
+                    scores[tag] = scores.get(tag, 0.0) + delta
+        
+        predicted = []
+        count = len(known)
+        for tag, delta in scores.items():
+            score = self.bias[tag] + count * self.unseen[tag] + base + delta
+            if score > 0:
+                predicted.append((score, tag))
+        if not predicted:
+            return [], 0.0
+        
+        predicted.sort(reverse=True)
+        predicted = predicted[:5]
+        weakest = predicted[-1][0]
+        confidence = 1 / (1 + math.exp(-weakest)) if weakest < 50 else 1.0
+        return [tag for _, tag in predicted], confidence
+
+
+class BudgetGovernor:
+    """Дневной бюджет OpenAI: расход по дням на диске и резерв под запросы в полете"""
+    
+    KEEP_DAYS = 31
+    
+    def __init__(self, path, price_per_1k=OPENAI_PRICE_PER_1K):
+        self.path = path
+        self.price_per_1k = price_per_1k
+        self.lock = threading.Lock()
+        self.days = {}
+        self.reserved = {}
+        self.next_reservation = 0
+        self.exhausted = False
+        self.scan_projected = 0
+        self.scan_actual = 0
+        self.scan_requests = 0
+        self.scan_refused = 0
+        self.load()
+    
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.days = json.load(f).get('days', {})
+        except (OSError, ValueError):
+            self.days = {}
+    
+    def save(self):
+        """Сохранить расход (хранятся последние KEEP_DAYS дней)"""
+        with self.lock:
+            days = dict(sorted(self.days.items())[-self.KEEP_DAYS:])
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'days': days}, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+    
+    def cost(self, tokens):
+        return tokens * self.price_per_1k / 1000
+    
+    def today(self):
+        """Расход за сегодня: {'tokens': ..., 'cost': ...}"""
+        return self.days.setdefault(datetime.now().strftime('%Y-%m-%d'), {'tokens': 0, 'cost': 0.0})
+    
+    def tokens_today(self):
+        with self.lock:
+            return self.today()['tokens']
+    
+    def cost_today(self):
+        with self.lock:
+            return self.today()['cost']
+    
+    def start_scan(self):
+        with self.lock:
+            self.exhausted = False
+            self.scan_projected = 0
+            self.scan_actual = 0
+            self.scan_requests = 0
+            self.scan_refused = 0
+    
+    def reserve(self, estimated_tokens, daily_limit):
+        """Зарезервировать оценку запроса; None - запрос не укладывается в дневной лимит"""
+        with self.lock:
+            planned = self.today()['cost'] + self.cost(sum(self.reserved.values()) + estimated_tokens)
+            if planned > daily_limit:
+                self.scan_refused += 1
+                if not self.exhausted:
+                    self.exhausted = True
+                    print(f"💸 Дневной лимит OpenAI ${daily_limit:g} исчерпан, дальше только локальные теги")
+                return None
+            self.next_reservation += 1
+            self.reserved[self.next_reservation] = estimated_tokens
+            self.scan_projected += estimated_tokens
+            return self.next_reservation
+    
+    def cancel(self, reservation):
+        """Снять резерв запроса, который так и не был отправлен"""
+        with self.lock:
+            estimated_tokens = self.reserved.pop(reservation, None)
+            if estimated_tokens is not None:
+                self.scan_projected -= estimated_tokens
+    
+    def release(self, reservation, actual_tokens):
+        """Снять резерв и учесть фактический расход"""
+        with self.lock:
+            self.reserved.pop(reservation, None)
+            day = self.today()
+            day['tokens'] += actual_tokens
+            day['cost'] += self.cost(actual_tokens)
+            self.scan_actual += actual_tokens
+            self.scan_requests += 1
+    
+    def report(self, daily_limit):
+        """Сводка сканирования: прогноз против факта"""
+        with self.lock:
+            if not self.scan_requests and not self.scan_refused:
+                return None
+            return (f"💰 OpenAI: запросов {self.scan_requests}, отклонено лимитом {self.scan_refused}; "
+                    f"прогноз {self.scan_projected} токенов (${self.cost(self.scan_projected):.4f}), "
+                    f"факт {self.scan_actual} токенов (${self.cost(self.scan_actual):.4f}); "
+                    f"за сегодня ${self.today()['cost']:.4f} из ${daily_limit:g}")
+
+
+class InflightRequests:
+    """Одинаковые запросы в пределах сканирования: первый выполняется, остальные ждут его результат"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.deduplicated = 0
+    
+    def claim(self, key):
+        """(запись, True если запрос выполняет вызывающий поток)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.deduplicated += 1
+                return entry, False
+            entry = self.entries[key] = [threading.Event(), []]
+            return entry, True
+    
+    @staticmethod
+    def resolve(entry, tags):
+        entry[1] = tags
+        entry[0].set()
+    
+    @staticmethod
+    def wait(entry):
+        entry[0].wait()
+        return entry[1]
+
+
+class CircuitBreaker:
+    """Предохранитель для OpenAI: после серии ошибок подряд запросы пропускаются на время паузы"""
+    
+    def __init__(self, threshold=3, cooldown=60, max_cooldown=600):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.trips = 0
+        self.skipped = 0
+    
+    def allow(self):
+        """Можно ли отправить запрос; после паузы пропускается один пробный"""
+        with self.lock:
+            if self.failures < self.threshold:
+                return True
+            if self.probing or time.monotonic() < self.open_until:
+                self.skipped += 1
+                return False
+            self.probing = True
+            return True
+    
+    def reset_stats(self):
+        with self.lock:
+            self.trips = 0
+            self.skipped = 0
+    
+    def is_open(self):
+        with self.lock:
+            return self.failures >= self.threshold
+    
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self.cooldown = self.base_cooldown
+    
+    def failure(self, trip=False):
+        """Учесть ошибку; trip - сработать сразу (сервер завис, ждать еще ответов незачем)"""
+        with self.lock:
+            self.failures = max(self.failures + 1, self.threshold if trip else 0)
+            if self.probing:
+                # Пробный запрос не прошел: пауза вдвое длиннее
+                self.probing = False
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.failures != self.threshold or self.open_until > time.monotonic():
+                return
+            self.open_until = time.monotonic() + self.cooldown
+            self.trips += 1
+            print(f"⚡ OpenAI недоступен ({self.failures} ошибок подряд), запросы на паузе {self.cooldown:.0f} с")
+
+
+PROGRESS_FPS = 10
+SORT_POLL_MS = 50
+LIVE_SEARCH_MIN_CHARS = 3
+
+
+class ScanProgress:
+    """Канал от потока сканирования к интерфейсу
+    
+    Поток сканирования только складывает счетчики под блокировкой и кладет события
+    в очередь; интерфейс сам опрашивает канал PROGRESS_FPS раз в секунду, так что
+    число обновлений экрана не зависит от числа файлов и папок. Обратно, от интерфейса
+    к конвейеру, идут отмена и пауза.
+    """
+    
+    RATE_WINDOW = 2.0
+    
+    def __init__(self, expected=0):
+        self.lock = threading.Lock()
+        self.events = queue.Queue()
+        self.files = 0
+        self.bytes = 0
+        self.extensions = Counter()
+        self.directory = ''
+        self.expected = expected
+        self.started = time.monotonic()
+        self.samples = deque()
+        self.cancelled = threading.Event()
+        self.running = threading.Event()
+        self.running.set()
+    
+    def cancel(self):
+        self.cancelled.set()
+        self.running.set()
+    
+    def pause(self):
+        self.running.clear()
+    
+    def resume(self):
+        self.running.set()
+    
+    @property
+    def paused(self):
+        return not self.running.is_set()
+    
+    def advance(self, records, directory, expected):
+        """Поток сканирования: добавить обработанные файлы"""
+        size_bytes = sum(file_info.size_bytes for file_info in records)
+        extensions = Counter(file_info.extension for file_info in records)
+        with self.lock:
+            self.files += len(records)
+            self.bytes += size_bytes
+            self.extensions.update(extensions)
+            self.directory = directory
+            self.expected = max(expected, self.files)
+    
+    def post(self, kind, payload=None):
+        """Поток сканирования: событие для интерфейса ('results', 'error', 'finished')"""
+        self.events.put((kind, payload))
+    
+    def drain(self):
+        """Интерфейс: все накопившиеся события"""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+    
+    def snapshot(self):
+        """Интерфейс: счетчики, скорость за последние RATE_WINDOW секунд и оценка остатка"""
+        now = time.monotonic()
+        with self.lock:
+            files, size, directory, expected = self.files, self.bytes, self.directory, self.expected
+            extensions = dict(self.extensions)
+        
+        self.samples.append((now, files))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.RATE_WINDOW:
+            self.samples.popleft()
+        then, files_then = self.samples[0]
+        if now - then >= 0.5:
+            rate = (files - files_then) / (now - then)
+        else:
+            rate = files / max(now - self.started, 1e-6)
+        eta = (expected - files) / rate if rate > 0 and expected > files else None
+        return ProgressSnapshot(files, size, directory, expected, rate, eta, extensions)
+
+
+def format_duration(seconds):
+    """Секунды в виде 1:05:09 или 5:09"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+RESULT_COLUMNS = ('name', 'path', 'size', 'extension', 'modified', 'tags')
+
+# Ключи сортировки по колонкам таблицы результатов
+RECORD_SORT_KEYS = {
+    'name': lambda file_info: file_info.name.lower(),
+    'path': lambda file_info: file_info.full_path.lower(),
+    'size': lambda file_info: file_info.size_bytes,
+    'extension': lambda file_info: file_info.extension.lower(),
+    'modified': lambda file_info: file_info.mtime,
+    'tags': lambda file_info: ', '.join(file_info.ai_tags),
+}
+
+
+def argsort(keys):
+    """Позиции keys по возрастанию ключа; при равных ключах сохраняется исходный порядок"""
+    if np is not None and keys and isinstance(keys[0], (int, float)):
+        return np.argsort(np.array(keys), kind='stable')
+    return sorted(range(len(keys)), key=keys.__getitem__)
+
+
+class SortedView:
+    """Элементы в порядке перестановки: срезы собираются по требованию, без копии списка"""
+    
+    def __init__(self, items, order, reverse=False):
+        self.items = items
+        self.order = order
+        self.reverse = reverse
+    
+    def __len__(self):
+        return len(self.order)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(len(self))[index]]
+        return self.items[self.position(index)]
+    
+    def position(self, index):
+        """Позиция в исходной последовательности для строки index"""
+        if index < 0:
+            index += len(self)
+        if self.reverse:
+            index = len(self.order) - 1 - index
+        return int(self.order[index])
+    
+    def reversed(self):
+        """Тот же порядок в обратную сторону"""
+        return SortedView(self.items, self.order, not self.reverse)
+
+
+class SortCache:
+    """Ключи и перестановки сортировки хранилища по колонкам
+    
+    Записи только добавляются, поэтому ключи колонки считаются один раз и дописываются
+    для новых строк; перестановка по возрастанию пересчитывается, только если строк
+    стало больше, а убывание - тот же порядок с конца.
+    """
+    
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.orders = {}
+    
+    def view(self, column, reverse=False, positions=None):
+        with self.lock:
+            keys = self.keys.setdefault(column, [])
+            keys.extend(self.store.sort_keys(column, len(keys)))
+            if positions is not None:
+                # Найденные файлы: готовые ключи, сортируются только их позиции
+                order = sorted(positions, key=keys.__getitem__)
+            else:
+                order = self.orders.get(column)
+                if order is None or len(order) != len(keys):
+                    order = self.orders[column] = argsort(keys)
+        return SortedView(self.store.view(), order, reverse)
+
+
+def size_indicator(size_mb):
+    """Размер с цветным индикатором, как в таблице и TXT отчете"""
+    if size_mb > 100:
+        return f"{size_mb} 🔴"
+    if size_mb > 10:
+        return f"{size_mb} 🟡"
+    return f"{size_mb} 🟢"
+
+
+class ResultsTable:
+    """Таблица результатов: в Treeview живут только видимые строки
+    
+    Показывается последовательность элементов (записи или id строк хранилища); записи
+    для видимого окна берутся через fetch при прокрутке, поэтому открытие и прокрутка
+    не зависят от числа файлов.
+    """
+    
+    WHEEL_ROWS = 3
+    
+    def __init__(self, parent, height=15):
+        self.tree = ttk.Treeview(parent, columns=RESULT_COLUMNS, show='headings',
+                                 height=height, selectmode='browse')
+        self.scrollbar = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=self.yview)
+        self.items = []
+        self.fetch = None
+        self.offset = 0
+        self.rows = height
+        self.selected = None
+        self.iids = []
+        self.record_ids = []
+        self.shown = 0
+        # Длина данных при последней отрисовке: view() памяти - тот же растущий список
+        self.rendered_count = 0
+        self.version = 0
+        
+        self.tree.bind('<Configure>', self.on_resize)
+        self.tree.bind('<MouseWheel>', self.on_wheel)
+        self.tree.bind('<Button-4>', lambda event: self.scroll(-self.WHEEL_ROWS))
+        self.tree.bind('<Button-5>', lambda event: self.scroll(self.WHEEL_ROWS))
+        self.tree.bind('<Button-1>', self.on_click)
+        self.tree.bind('<Button-3>', self.on_click, add='+')
+        self.tree.bind('<Up>', lambda event: self.move_selection(-1))
+        self.tree.bind('<Down>', lambda event: self.move_selection(1))
+        self.tree.bind('<Prior>', lambda event: self.move_selection(-self.rows))
+        self.tree.bind('<Next>', lambda event: self.move_selection(self.rows))
+        self.tree.bind('<Home>', lambda event: self.move_selection(-len(self.items)))
+        self.tree.bind('<End>', lambda event: self.move_selection(len(self.items)))
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def set_items(self, items, fetch=None):
+        """Показать новые данные с начала; fetch(срез) -> записи, None - элементы уже записи"""
+        self.items = items
+        self.fetch = fetch
+        self.offset = 0
+        self.selected = None
+        self.version += 1
+        self.render()
+    
+    def extend_items(self, items):
+        """Те же данные с новыми строками в конце (идет сканирование): позиция и выделение сохраняются"""
+        self.items = items
+        if len(items) != self.rendered_count:
+            self.render()
+    
+    def clear(self):
+        self.set_items([])
+    
+    @staticmethod
+    def row_values(file_info):
+        return (file_info.name, file_info.full_path, size_indicator(file_info.size_mb),
+                file_info.extension, file_info.modified_date, ', '.join(file_info.ai_tags))
+    
+    def window(self, start, count):
+        """Записи строк [start, start + count)"""
+        items = self.items[start:start + count]
+        return self.fetch(items) if self.fetch is not None else items
+    
+    def row_id(self, row):
+        """Постоянный id записи строки row - ее позиция в хранилище"""
+        return self.items.position(row) if isinstance(self.items, SortedView) else row
+    
+    def record_id(self, iid):
+        """id записи, показанной в строке Treeview iid, или None"""
+        if iid in self.iids[:self.shown]:
+            return self.record_ids[self.iids.index(iid)]
+        return None
+    
+    def selected_id(self):
+        """id записи выделенной строки (даже прокрученной за пределы окна) или None"""
+        if self.selected is None or self.selected >= len(self.items):
+            return None
+        return self.row_id(self.selected)
+    
+    def render(self):
+        """Перерисовать видимое окно: Treeview строк больше не становится"""
+        total = self.rendered_count = len(self.items)
+        self.offset = max(0, min(self.offset, total - self.rows))
+        records = self.window(self.offset, self.rows)
+        self.record_ids = [self.row_id(self.offset + index) for index in range(len(records))]
+        
+        while len(self.iids) < len(records):
+            self.iids.append(self.tree.insert('', 'end'))
+        for index, file_info in enumerate(records):
+            iid = self.iids[index]
+            self.tree.item(iid, values=self.row_values(file_info))
+            if index >= self.shown:
+                self.tree.move(iid, '', index)
+        if self.shown > len(records):
+            self.tree.detach(*self.iids[len(records):self.shown])
+        self.shown = len(records)
+        
+        position = None if self.selected is None else self.selected - self.offset
+        if position is not None and 0 <= position < self.shown:
+            self.tree.selection_set(self.iids[position])
+        elif self.tree.selection():
+            self.tree.selection_remove(*self.tree.selection())
+        
+        if total:
+            self.scrollbar.set(self.offset / total, min(self.offset + self.rows, total) / total)
+        else:
+            self.scrollbar.set(0, 1)
+    
+    def scroll(self, rows):
+        self.offset += rows
+        self.render()
+        return 'break'
+    
+    def yview(self, *args):
+        """Команда полосы прокрутки: moveto доля | scroll n units/pages"""
+        if args[0] == 'moveto':
+            self.offset = int(float(args[1]) * len(self.items))
+        elif args[0] == 'scroll':
+            count = int(args[1])
+            self.offset += count * (self.rows if args[2] == 'pages' else 1)
+        self.render()
+    
+    def on_wheel(self, event):
+        return self.scroll(-self.WHEEL_ROWS if event.delta > 0 else self.WHEEL_ROWS)
+    
+    def on_resize(self, event):
+        """Число строк окна по высоте виджета"""
+        if not self.shown:
+            return
+        bbox = self.tree.bbox(self.iids[0])
+        if not bbox or bbox[3] <= 0:
+            return
+        rows = max(1, (event.height - bbox[1]) // bbox[3])
+        if rows != self.rows:
+            self.rows = rows
+            self.render()
+    
+    def on_click(self, event):
+        iid = self.tree.identify_row(event.y)
+        if iid in self.iids[:self.shown]:
+            self.selected = self.offset + self.iids.index(iid)
+            self.tree.selection_set(iid)
+    
+    def move_selection(self, step):
+        """Стрелки и Page Up/Down: выделение двигается, окно прокручивается за ним"""
+        if not self.items:
+            return 'break'
+        current = self.selected if self.selected is not None else self.offset - (1 if step > 0 else 0)
+        self.selected = max(0, min(current + step, len(self.items) - 1))
+        if self.selected < self.offset:
+            self.offset = self.selected
+        elif self.selected >= self.offset + self.rows:
+            self.offset = self.selected - self.rows + 1
+        self.render()
+        return 'break'
+
+
 class FileScannerGUI:
     def __init__(self, root):
         self.root = root
@@ -20,10 +2548,17 @@ class FileScannerGUI:
         self.root.minsize(800, 600)
         
         # Данные
-        self.files_data = []
+        self.files_data = ScanStore()
         self.scanning = False
-        self.scan_progress = 0
+        self.scan_progress = None
+        self.closing = False
         self.total_files_to_scan = 0
+        self.scan_counts = {}
+        self.pipeline = None
+        self.scan_threads = tk.IntVar(value=1)
+        self.incremental_scan = tk.BooleanVar(value=True)
+        self.use_sqlite = tk.BooleanVar(value=False)
+        self.last_store = None
         
         # AI настройки
         self.ai_enabled = tk.BooleanVar(value=True)
@@ -31,20 +2566,46 @@ class FileScannerGUI:
         self.openai_api_key = tk.StringVar()
         self.openai_model = tk.StringVar(value="gpt-3.5-turbo")
         self.daily_limit = tk.StringVar(value="1.00")
-        self.tokens_used_today = 0
+        self.openai_workers = tk.IntVar(value=4)
+        self.openai_base_url = tk.StringVar(value=OPENAI_BASE_URL)
+        self.openai_client = None
+        self.openai_client_key = None
+        self.openai_client_lock = threading.Lock()
+        self.openai_batching = tk.BooleanVar(value=True)
+        self.openai_batch_limit = OPENAI_BATCH_FILES
+        self.scan_requests = InflightRequests()
+        self.scan_templates = InflightRequests()
+        self.openai_routed = 0
+        self.budget = BudgetGovernor(self.get_usage_file())
+        self.breaker = CircuitBreaker()
+        self.openai_deadline = tk.IntVar(value=30)
+        self.remote_deadline = None
+        self.remote_deadline_hit = False
         
         # Дополнительные AI переменные
         self.ai_mode = tk.StringVar(value="hybrid")
         self.ai_for_unknown = tk.BooleanVar(value=True)
         self.ai_for_documents = tk.BooleanVar(value=True)
         self.ai_for_projects = tk.BooleanVar(value=False)
+        self.cluster_templates = tk.BooleanVar(value=True)
         self.enable_cache = tk.BooleanVar(value=True)
+        self.cache_max_entries = tk.IntVar(value=100000)
+        self.tag_cache = None
+        self.learned_tagger = tk.BooleanVar(value=False)
+        self.learned_threshold = tk.DoubleVar(value=0.8)
+        self.tag_classifier = None
+        self.tag_classifier_key = None
+        self.learned_used = 0
+        self.tag_processes = tk.BooleanVar(value=False)
+        self.tag_pool = None
+        self.scan_settings = None
         
         # Темная тема
         self.dark_theme = False
         
         # AI теги
         self.ai_tag_patterns = self.load_ai_patterns()
+        self.compile_ai_rules()
         
         # Настройка стиля
         self.setup_styles()
@@ -54,6 +2615,7 @@ class FileScannerGUI:
         
         # Горячие клавиши
         self.setup_hotkeys()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
         # Центрируем окно
         self.center_window()
@@ -154,6 +2716,8 @@ class FileScannerGUI:
     def setup_hotkeys(self):
         """Настройка горячих клавиш"""
         self.root.bind('<F5>', lambda e: self.start_scan())
+        self.root.bind('<F6>', lambda e: self.toggle_pause())
+        self.root.bind('<Escape>', lambda e: self.cancel_scan())
         self.root.bind('<Control-s>', lambda e: self.save_json())
         self.root.bind('<Control-t>', lambda e: self.save_txt())
         self.root.bind('<Control-e>', lambda e: self.save_csv_auto())
@@ -164,6 +2728,16 @@ class FileScannerGUI:
         self.root.bind('<F1>', lambda e: self.show_help())
         self.root.bind('<F2>', lambda e: self.show_ai_settings())
     
+    def on_close(self):
+        """Закрытие окна: идущее сканирование останавливается, окно закрывается
+        после записи контрольной точки (в scan_complete)"""
+        if self.scanning and self.scan_progress is not None:
+            self.closing = True
+            self.cancel_scan()
+            self.progress_var.set("Сохранение контрольной точки перед закрытием...")
+            return
+        self.root.destroy()
+    
     def center_window(self):
         """Центрирует окно на экране"""
         self.root.update_idletasks()
@@ -216,73 +2790,31 @@ class FileScannerGUI:
             }
         }
     
-    def generate_ai_tags(self, file_info):
+    def compile_ai_rules(self):
+        """Скомпилировать правила после загрузки или изменения ai_tag_patterns"""
+        self.tag_rules = TagRules(self.ai_tag_patterns)
+    
+    def generate_ai_tags(self, file_info, settings=None):
         """Генерация AI тегов для файла"""
-        if not self.ai_enabled.get():
+        if not (settings.ai_enabled if settings else self.ai_enabled.get()):
             return []
         
-        filename = file_info['name'].lower()
-        filepath = file_info['full_path'].lower()
-        extension = file_info['extension'].lower()
-        
-        tags = set()
-        
-        for category, data in self.ai_tag_patterns.items():
-            for pattern in data['patterns']:
-                if re.search(pattern, filename) or re.search(pattern, filepath):
-                    tags.update(data['tags'])
-                    break
-        
-        size_mb = file_info['size_mb']
-        if size_mb > 1000:
-            tags.add('большой')
-        elif size_mb > 100:
-            tags.add('средний')
-        else:
-            tags.add('маленький')
-        
-        try:
-            modified_date = datetime.strptime(file_info['modified_date'], '%Y-%m-%d %H:%M:%S')
-            days_old = (datetime.now() - modified_date).days
-            
-            if days_old < 7:
-                tags.add('новый')
-            elif days_old < 30:
-                tags.add('недавний')
-            elif days_old > 365:
-                tags.add('старый')
-        except:
-            pass
-        
-        if extension in ['.exe', '.msi', '.dmg']:
-            tags.add('приложение')
-        elif extension in ['.txt', '.doc', '.docx', '.pdf']:
-            tags.add('документ')
-        elif extension in ['.jpg', '.png', '.gif', '.bmp']:
-            tags.add('изображение')
-        elif extension in ['.mp3', '.wav', '.flac']:
-            tags.add('аудио')
-        elif extension in ['.mp4', '.avi', '.mkv']:
-            tags.add('видео')
+        tag_rules = settings.tag_rules if settings else self.tag_rules
+        tags = local_ai_tags(tag_rules, file_info.name.lower(), file_info.full_path.lower(),
+                             file_info.extension.lower(), file_info.size_mb, file_info.mtime)
         
         return list(tags)[:5]
     
-    def generate_openai_tags(self, file_info):
+    def generate_openai_tags(self, file_info, settings=None):
         """Генерация тегов через OpenAI API"""
-        if not self.openai_enabled.get() or not self.openai_api_key.get():
+        settings = settings or self.get_scan_settings()
+        if not settings.openai_enabled or not settings.openai_api_key:
             return []
         
         try:
-            daily_limit = float(self.daily_limit.get())
-            estimated_cost = 0.0015 * 100 / 1000
-            
-            if estimated_cost > daily_limit:
-                print(f"Превышен дневной лимит: ${estimated_cost:.4f} > ${daily_limit}")
-                return []
-            
-            filename = file_info['name']
-            file_extension = file_info['extension']
-            file_size = file_info['size_mb']
+            filename = file_info.name
+            file_extension = file_info.extension
+            file_size = file_info.size_mb
             
             prompt = f"""Проанализируй файл и создай до 5 коротких тегов на русском языке:
 
@@ -297,35 +2829,15 @@ class FileScannerGUI:
 
 Ответ только теги через запятую, без объяснений."""
             
-            headers = {
-                'Authorization': f'Bearer {self.openai_api_key.get()}',
-                'Content-Type': 'application/json'
-            }
-            
-            data = {
-                'model': self.openai_model.get(),
-                'messages': [{'role': 'user', 'content': prompt}],
-                'max_tokens': 100,
-                'temperature': 0.3
-            }
-            
-            response = requests.post(
-                'https://api.openai.com/v1/chat/completions',
-                headers=headers,
-                json=data,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content'].strip()
-                tags = [tag.strip() for tag in content.split(',') if tag.strip()]
-                self.tokens_used_today += result.get('usage', {}).get('total_tokens', 0)
-                return tags[:5]
-            else:
-                print(f"OpenAI API Error: {response.status_code} - {response.text}")
+            reply = self.openai_chat(prompt, settings=settings)
+            if reply is None:
                 return []
-                
+            tags = [tag.strip() for tag in reply.content.split(',') if tag.strip()]
+            return tags[:5]
+        
+        except OpenAIError as e:
+            print(f"OpenAI API Error: {e}")
+            return []
         except requests.RequestException as e:
             print(f"Ошибка подключения к OpenAI: {e}")
             return []
@@ -333,13 +2845,322 @@ class FileScannerGUI:
             print(f"Ошибка OpenAI API: {e}")
             return []
     
-    def combine_ai_tags(self, file_info):
-        """Объединить локальные и OpenAI теги"""
-        local_tags = self.generate_ai_tags(file_info)
-        openai_tags = self.generate_openai_tags(file_info)
+    def generate_openai_tags_batch(self, records, settings):
+        """Теги OpenAI для нескольких файлов: одна инструкция и JSON ответ на пакет"""
+        if not settings.openai_enabled or not settings.openai_api_key:
+            return [[] for _ in records]
+        
+        results = []
+        start = 0
+        while start < len(records):
+            # Размер пакета подбирается по бюджету токенов запроса и уменьшается,
+            # если модель не уложилась в max_tokens
+            lines = []
+            tokens = estimate_tokens(OPENAI_BATCH_PROMPT)
+            for file_info in records[start:start + self.openai_batch_limit]:
+                line = f"{len(lines) + 1} | {file_info.name} | {file_info.extension} | {file_info.size_mb}"
+                line_tokens = estimate_tokens(line) + OPENAI_TOKENS_PER_FILE
+                if lines and tokens + line_tokens > OPENAI_BATCH_TOKENS:
+                    break
+                lines.append(line)
+                tokens += line_tokens
+            
+            chunk = records[start:start + len(lines)]
+            start += len(chunk)
+            results.extend(self.request_openai_batch(chunk, lines, settings))
+        return results
+    
+    def request_openai_batch(self, chunk, lines, settings):
+        """Один пакетный запрос; файлы без разобранного ответа запрашиваются по одному"""
+        if len(chunk) == 1:
+            # Лимит, сжатый до одного файла, понемногу возвращаем к пакетам
+            with self.openai_client_lock:
+                self.openai_batch_limit = min(OPENAI_BATCH_FILES, self.openai_batch_limit + 1)
+            return [self.generate_openai_tags(chunk[0], settings)]
+        
+        prompt = OPENAI_BATCH_PROMPT.format(files='\n'.join(lines))
+        try:
+            reply = self.openai_chat(prompt, max_tokens=len(chunk) * OPENAI_TOKENS_PER_FILE, settings=settings)
+            if reply is None:
+                return [[] for _ in chunk]
+            parsed = parse_batch_tags(reply.content, len(chunk))
+        except Exception as e:
+            print(f"Ошибка пакетного запроса OpenAI ({len(chunk)} файлов): {e}")
+            return [[] for _ in chunk]
+        
+        with self.openai_client_lock:
+            if reply.finish_reason == 'length':
+                self.openai_batch_limit = max(1, len(chunk) // 2)
+            elif None not in parsed and len(chunk) >= self.openai_batch_limit:
+                self.openai_batch_limit = min(OPENAI_BATCH_FILES, self.openai_batch_limit + max(1, len(chunk) // 4))
+        
+        return [tags if tags is not None else self.generate_openai_tags(file_info, settings)
+                for file_info, tags in zip(chunk, parsed)]
+    
+    def get_cache_max_entries(self):
+        """Максимум записей в кэше AI тегов"""
+        try:
+            return max(int(self.cache_max_entries.get()), 100)
+        except (tk.TclError, ValueError):
+            return 100000
+    
+    def get_cache_file(self):
+        """Получить путь к кэшу AI тегов"""
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(script_dir, 'ai_cache.db')
+    
+    def get_tag_cache(self, max_entries=None):
+        """Кэш AI тегов (открывается при первом обращении)
+        
+        Потоки сканирования передают max_entries готовым числом: переменная Tk читается
+        только через главный цикл, и ждать его под openai_client_lock нельзя - главный
+        поток берет этот же замок (F2, очистка кэша, обучение модели).
+        """
+        if max_entries is None:
+            max_entries = self.get_cache_max_entries()
+        with self.openai_client_lock:
+            if self.tag_cache is None:
+                try:
+                    self.tag_cache = TagCache(self.get_cache_file(), max_entries)
+                except sqlite3.Error as e:
+                    print(f"Ошибка открытия кэша AI: {e}")
+                    return None
+            self.tag_cache.max_entries = max_entries
+            return self.tag_cache
+    
+    def get_learned_threshold(self):
+        """Уверенность модели, начиная с которой файл не отправляется в OpenAI"""
+        try:
+            return min(max(float(self.learned_threshold.get()), 0.5), 0.999)
+        except (tk.TclError, ValueError):
+            return 0.8
+    
+    def get_tag_classifier(self, settings=None):
+        """Модель тегов, обученная на кэше OpenAI; переобучается только после изменений кэша"""
+        settings = settings or self.get_scan_settings()
+        cache = self.get_tag_cache(settings.cache_max_entries)
+        if cache is None:
+            return None
+        model = settings.openai_model
+        key = (cache.path, model, cache.version)
+        if self.tag_classifier is None or self.tag_classifier_key != key:
+            examples = cache.examples(model)
+            if len(examples) < LEARNED_MIN_EXAMPLES:
+                return None
+            start = time.perf_counter()
+            self.tag_classifier = TagClassifier().train(examples)
+            self.tag_classifier_key = key
+            print(f"🎓 Модель тегов обучена на {len(examples)} файлах из кэша "
+                  f"за {time.perf_counter() - start:.2f} с")
+        return self.tag_classifier
+    
+    def cache_status_text(self):
+        """Строка для метки кэша в настройках AI"""
+        cache = self.get_tag_cache()
+        if cache is None:
+            return "📁 Кэш: недоступен"
+        return (f"📁 Кэш: {len(cache)} файлов, {cache.size_mb():.1f} MB · "
+                f"попаданий {cache.hits}, промахов {cache.misses}")
+    
+    def cached_openai_tags(self, records, settings):
+        """Теги OpenAI для файлов; с включенным кэшем в API уходят только новые файлы"""
+        if not settings.openai_enabled or not settings.openai_api_key:
+            return [[] for _ in records]
+        
+        cache = self.get_tag_cache(settings.cache_max_entries) if settings.enable_cache else None
+        model = settings.openai_model
+        keys = [TagCache.key(file_info, model) for file_info in records]
+        tags = [None] * len(records)
+        owned = []
+        waiting = []
+        for index, key in enumerate(keys):
+            if cache is not None:
+                tags[index] = cache.get(key)
+                if tags[index] is not None:
+                    continue
+            entry, owner = self.scan_requests.claim(key)
+            (owned if owner else waiting).append((index, entry))
+        
+        fetched = []
+        try:
+            if owned:
+                fetched = self.request_openai_tags([records[index] for index, _ in owned], settings)
+            for (index, entry), file_tags in zip(owned, fetched):
+                tags[index] = file_tags
+                # Пустой ответ - скорее ошибка запроса, его не кэшируем
+                if file_tags and cache is not None:
+                    cache.put(keys[index], file_tags)
+        finally:
+            for (index, entry) in owned:
+                InflightRequests.resolve(entry, tags[index] or [])
+        
+        for index, entry in waiting:
+            tags[index] = InflightRequests.wait(entry)
+        return tags
+    
+    def clustered_openai_tags(self, records, templates, settings):
+        """Теги OpenAI по одному файлу на шаблон имени; остальные файлы семейства получают те же теги"""
+        tags = [None] * len(records)
+        owned = []
+        waiting = []
+        for index, template in enumerate(templates):
+            # Расширение уже входит в шаблон, так что report_#.pdf и report_#.txt - разные семейства
+            entry, owner = self.scan_templates.claim(template)
+            (owned if owner else waiting).append((index, entry))
+        with self.openai_client_lock:
+            self.openai_routed += len(owned)
+        
+        try:
+            fetched = self.cached_openai_tags([records[index] for index, _ in owned], settings)
+            for (index, entry), file_tags in zip(owned, fetched):
+                tags[index] = file_tags
+        finally:
+            for index, entry in owned:
+                InflightRequests.resolve(entry, tags[index] or [])
+        
+        for index, entry in waiting:
+            tags[index] = InflightRequests.wait(entry)
+        return tags
+    
+    def request_openai_tags(self, records, settings):
+        """Запросить теги OpenAI пакетами или по одному файлу, как задано в настройках"""
+        if settings.openai_batching:
+            return self.generate_openai_tags_batch(records, settings)
+        return [self.generate_openai_tags(file_info, settings) for file_info in records]
+    
+    def get_openai_deadline(self):
+        """Минут на OpenAI за одно сканирование (0 - без ограничения)"""
+        try:
+            return max(int(self.openai_deadline.get()), 0)
+        except (tk.TclError, ValueError):
+            return 30
+    
+    def get_daily_limit(self):
+        """Дневной лимит расходов OpenAI в долларах"""
+        try:
+            return float(self.daily_limit.get())
+        except (tk.TclError, ValueError):
+            return 0.0
+    
+    def get_usage_file(self):
+        """Получить путь к файлу расхода OpenAI по дням"""
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(script_dir, 'ai_usage.json')
+    
+    def remote_time_left(self):
+        """Секунды до дедлайна OpenAI текущего сканирования (None - без дедлайна)"""
+        if self.remote_deadline is None:
+            return None
+        return self.remote_deadline - time.monotonic()
+    
+    def openai_chat(self, prompt, max_tokens=100, settings=None):
+        """Запрос к OpenAI в рамках бюджета, дедлайна и предохранителя; None - запрос пропущен"""
+        settings = settings or self.get_scan_settings()
+        time_left = self.remote_time_left()
+        if time_left is not None and time_left <= 0:
+            if not self.remote_deadline_hit:
+                self.remote_deadline_hit = True
+                print("⏱️ Время OpenAI на сканирование вышло, дальше только локальные теги")
+            return None
+        # Оценка сверху: промпт плюс весь max_tokens ответа. Бюджет проверяется до
+        # предохранителя: разрешенный им пробный запрос должен закончиться success/failure
+        reservation = self.budget.reserve(estimate_tokens(prompt) + max_tokens, settings.daily_limit)
+        if reservation is None:
+            return None
+        if not self.breaker.allow():
+            self.budget.cancel(reservation)
+            return None
+        
+        actual_tokens = 0
+        try:
+            for attempt in range(OPENAI_RETRIES + 1):
+                # Время на ответ растет с его длиной, но не выходит за дедлайн сканирования
+                read_timeout = min(OpenAIClient.TIMEOUT[1], 10 + max_tokens / 100)
+                time_left = self.remote_time_left()
+                if time_left is not None:
+                    read_timeout = max(1.0, min(read_timeout, time_left))
+                timeout = (OpenAIClient.TIMEOUT[0], read_timeout)
+                try:
+                    reply = self.get_openai_client(settings).chat(settings.openai_model, prompt,
+                                                                  max_tokens=max_tokens, timeout=timeout)
+                except (requests.RequestException, OpenAIError) as e:
+                    self.breaker.failure(trip=isinstance(e, requests.Timeout))
+                    # Повторяем только временные ошибки, пока предохранитель не сработал.
+                    # Зависший сервер (таймаут чтения) не повторяем: каждая попытка - это полный таймаут
+                    status = getattr(e, 'status', None)
+                    retryable = ((status is None and not isinstance(e, requests.ReadTimeout)) or
+                                 (status is not None and (status >= 500 or status in (408, 429))))
+                    delay = min(OPENAI_BACKOFF * 2 ** attempt, OPENAI_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+                    time_left = self.remote_time_left()
+                    if (not retryable or attempt == OPENAI_RETRIES or self.breaker.is_open() or
+                            (time_left is not None and time_left <= delay)):
+                        raise
+                    time.sleep(delay)
+                    continue
+                except Exception:
+                    # Неожиданный ответ (например, без choices) - тоже ошибка, иначе проба не закончится
+                    self.breaker.failure()
+                    raise
+                
+                self.breaker.success()
+                actual_tokens = reply.total_tokens
+                return reply
+        finally:
+            self.budget.release(reservation, actual_tokens)
+    
+    def save_usage(self):
+        """Сохранить расход OpenAI по дням"""
+        try:
+            self.budget.save()
+        except OSError as e:
+            print(f"Ошибка сохранения расхода OpenAI: {e}")
+    
+    def get_openai_client(self, settings):
+        """Общий клиент OpenAI; пересоздается при смене ключа, адреса или числа запросов"""
+        key = (settings.openai_api_key, settings.openai_base_url, settings.openai_workers)
+        with self.openai_client_lock:
+            if self.openai_client is None or self.openai_client_key != key:
+                self.openai_client = OpenAIClient(*key)
+                self.openai_client_key = key
+            return self.openai_client
+    
+    def get_ai_route(self):
+        """Режим AI и фильтры гибрида одним кортежем (читается раз на пакет, а не на файл)"""
+        return (self.ai_mode.get(), self.ai_for_unknown.get(),
+                self.ai_for_documents.get(), self.ai_for_projects.get())
+    
+    def needs_openai(self, file_info, local_tags, route=None):
+        """Нужен ли файлу запрос к OpenAI при текущем режиме и фильтрах"""
+        mode, for_unknown, for_documents, for_projects = route or self.get_ai_route()
+        if mode == 'local':
+            return False
+        if mode == 'openai':
+            return True
+        
+        if for_unknown and GENERIC_TAGS.issuperset(local_tags):
+            return True
+        if for_documents and file_info.extension.lower() in DOCUMENT_EXTENSIONS:
+            return True
+        if for_projects and not PROJECT_TAGS.isdisjoint(local_tags):
+            return True
+        return False
+    
+    def merge_ai_tags(self, local_tags, openai_tags, mode=None):
+        """Объединить уже полученные локальные и OpenAI теги"""
+        if (mode or self.ai_mode.get()) == 'openai' and openai_tags:
+            return openai_tags[:7]
         all_tags = list(set(local_tags + openai_tags))
         return all_tags[:7]
     
+    def combine_ai_tags(self, file_info):
+        """Объединить локальные и OpenAI теги"""
+        settings = self.get_scan_settings()
+        local_tags = self.generate_ai_tags(file_info, settings)
+        openai_tags = []
+        if self.needs_openai(file_info, local_tags, settings.route):
+            openai_tags = self.generate_openai_tags(file_info, settings)
+        return self.merge_ai_tags(local_tags, openai_tags, settings.route[0])
+    
     def save_json(self):
         """Быстрое сохранение в JSON"""
         self.save_file_auto('json')
@@ -352,6 +3173,89 @@ class FileScannerGUI:
         """Быстрое сохранение в CSV"""
         self.save_file_auto('csv')
     
+    def get_scan_threads(self):
+        """Число потоков чтения папок из настроек"""
+        try:
+            return min(max(int(self.scan_threads.get()), 1), 64)
+        except (tk.TclError, ValueError):
+            return 1
+    
+    def get_openai_workers(self):
+        """Число одновременных запросов к OpenAI во время сканирования"""
+        try:
+            return min(max(int(self.openai_workers.get()), 1), 32)
+        except (tk.TclError, ValueError):
+            return 1
+    
+    def get_scan_index_file(self, directory):
+        """Получить путь к индексу папок для быстрого пересканирования"""
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        key = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()
+        return os.path.join(script_dir, 'scan_index', f'{key}.json')
+    
+    def get_scan_index_params(self, settings):
+        """Настройки, при изменении которых индекс папок устаревает"""
+        rules = json.dumps(settings.rules, ensure_ascii=False, sort_keys=True)
+        return {
+            'include_hidden': settings.include_hidden,
+            'file_extensions': sorted(settings.file_extensions or []),
+            'ai_enabled': settings.ai_enabled,
+            'openai_enabled': settings.openai_enabled,
+            # Режим и фильтры гибрида решают, какие файлы получили теги OpenAI и какой моделью
+            'ai_route': list(settings.route),
+            'openai_model': settings.openai_model,
+            'cluster_templates': settings.cluster_templates,
+            # Модель тегов заменяет часть ответов OpenAI
+            'learned_tagger': settings.learned_tagger,
+            'learned_threshold': settings.learned_threshold,
+            'rules': hashlib.sha1(rules.encode('utf-8')).hexdigest()
+        }
+    
+    def get_checkpoint_file(self, directory):
+        """Получить путь к контрольной точке сканирования папки"""
+        return self.get_scan_index_file(directory)[:-len('.json')] + '.checkpoint'
+    
+    def get_scan_options(self):
+        """Скрытые файлы и список расширений из полей главного окна"""
+        include_hidden = self.include_hidden.get()
+        extensions_text = self.extensions_var.get().strip()
+        file_extensions = None
+        
+        if extensions_text:
+            file_extensions = [ext.strip().lower() for ext in extensions_text.split() if ext.strip()]
+        return include_hidden, file_extensions
+    
+    def get_scan_settings(self):
+        """Снимок настроек сканирования (только из главного потока)"""
+        include_hidden, file_extensions = self.get_scan_options()
+        return ScanSettings(
+            include_hidden=include_hidden,
+            file_extensions=file_extensions,
+            scan_threads=self.get_scan_threads(),
+            incremental_scan=self.incremental_scan.get(),
+            use_sqlite=self.use_sqlite.get(),
+            ai_enabled=self.ai_enabled.get(),
+            tag_processes=self.tag_processes.get(),
+            # Редактор правил меняет ai_tag_patterns на месте, а compile_ai_rules
+            # заменяет tag_rules новым объектом: копии хватает словарю
+            rules=copy.deepcopy(self.ai_tag_patterns),
+            tag_rules=self.tag_rules,
+            openai_enabled=self.openai_enabled.get(),
+            openai_api_key=self.openai_api_key.get(),
+            openai_base_url=self.openai_base_url.get().strip() or OPENAI_BASE_URL,
+            openai_model=self.openai_model.get(),
+            openai_workers=self.get_openai_workers(),
+            openai_batching=self.openai_batching.get(),
+            openai_deadline=self.get_openai_deadline(),
+            daily_limit=self.get_daily_limit(),
+            enable_cache=self.enable_cache.get(),
+            cache_max_entries=self.get_cache_max_entries(),
+            learned_tagger=self.learned_tagger.get(),
+            learned_threshold=self.get_learned_threshold(),
+            cluster_templates=self.cluster_templates.get(),
+            route=self.get_ai_route()
+        )
+    
     def get_settings_file(self):
         """Получить путь к файлу настроек"""
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -365,13 +3269,27 @@ class FileScannerGUI:
             'openai_api_key': self.openai_api_key.get(),
             'openai_model': self.openai_model.get(),
             'daily_limit': self.daily_limit.get(),
+            'openai_workers': self.get_openai_workers(),
+            'openai_base_url': self.openai_base_url.get(),
+            'openai_batching': self.openai_batching.get(),
+            'openai_deadline': self.get_openai_deadline(),
             'ai_mode': self.ai_mode.get(),
             'ai_for_unknown': self.ai_for_unknown.get(),
             'ai_for_documents': self.ai_for_documents.get(),
             'ai_for_projects': self.ai_for_projects.get(),
+            'cluster_templates': self.cluster_templates.get(),
             'enable_cache': self.enable_cache.get(),
+            'cache_max_entries': self.get_cache_max_entries(),
+            'learned_tagger': self.learned_tagger.get(),
+            'learned_threshold': self.get_learned_threshold(),
+            'tag_processes': self.tag_processes.get(),
             'ai_tag_patterns': self.ai_tag_patterns,
-            'dark_theme': self.dark_theme
+            'dark_theme': self.dark_theme,
+            'scan_threads': self.get_scan_threads(),
+            'incremental_scan': self.incremental_scan.get(),
+            'use_sqlite': self.use_sqlite.get(),
+            'last_store': self.last_store,
+            'scan_counts': self.scan_counts
         }
         
         try:
@@ -397,14 +3315,29 @@ class FileScannerGUI:
             self.openai_api_key.set(settings.get('openai_api_key', ''))
             self.openai_model.set(settings.get('openai_model', 'gpt-3.5-turbo'))
             self.daily_limit.set(settings.get('daily_limit', '1.00'))
+            self.openai_workers.set(settings.get('openai_workers', 4))
+            self.openai_base_url.set(settings.get('openai_base_url', OPENAI_BASE_URL))
+            self.openai_batching.set(settings.get('openai_batching', True))
+            self.openai_deadline.set(settings.get('openai_deadline', 30))
             self.ai_mode.set(settings.get('ai_mode', 'hybrid'))
             self.ai_for_unknown.set(settings.get('ai_for_unknown', True))
             self.ai_for_documents.set(settings.get('ai_for_documents', True))
             self.ai_for_projects.set(settings.get('ai_for_projects', False))
+            self.cluster_templates.set(settings.get('cluster_templates', True))
             self.enable_cache.set(settings.get('enable_cache', True))
+            self.cache_max_entries.set(settings.get('cache_max_entries', 100000))
+            self.learned_tagger.set(settings.get('learned_tagger', False))
+            self.learned_threshold.set(settings.get('learned_threshold', 0.8))
+            self.tag_processes.set(settings.get('tag_processes', False))
             
             if 'ai_tag_patterns' in settings:
                 self.ai_tag_patterns.update(settings['ai_tag_patterns'])
+                self.compile_ai_rules()
+            
+            self.scan_threads.set(settings.get('scan_threads', 1))
+            self.incremental_scan.set(settings.get('incremental_scan', True))
+            self.use_sqlite.set(settings.get('use_sqlite', False))
+            self.scan_counts = settings.get('scan_counts', {})
             
             if settings.get('dark_theme', False):
                 self.dark_theme = True
@@ -412,6 +3345,10 @@ class FileScannerGUI:
             
             print("✅ Настройки загружены из ai_settings.json")
             
+            last_store = settings.get('last_store')
+            if self.use_sqlite.get() and last_store and os.path.exists(last_store):
+                self.open_store(last_store)
+            
         except Exception as e:
             print(f"Ошибка загрузки настроек: {e}")
     
@@ -446,6 +3383,9 @@ class FileScannerGUI:
         
         ttk.Button(folder_frame, text="Обзор...", command=self.browse_folder).grid(row=0, column=2)
         
+        ttk.Button(folder_frame, text="📂 Открыть скан...", 
+                  command=self.browse_store).grid(row=0, column=3, padx=(10, 0))
+        
         settings_frame = ttk.LabelFrame(main_frame, text="Настройки сканирования", padding="10")
         settings_frame.grid(row=2, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(0, 10))
         
@@ -463,6 +3403,21 @@ class FileScannerGUI:
         ttk.Label(options_frame, text="🤖 AI: настройки в F2", 
                  font=('Arial', 8)).grid(row=0, column=2, sticky=tk.W, padx=(20, 0))
         
+        threads_frame = ttk.Frame(options_frame)
+        threads_frame.grid(row=1, column=0, columnspan=3, sticky=tk.W, pady=(5, 0))
+        
+        ttk.Label(threads_frame, text="Потоков чтения:").pack(side=tk.LEFT)
+        ttk.Spinbox(threads_frame, from_=1, to=64, textvariable=self.scan_threads, 
+                    width=4).pack(side=tk.LEFT, padx=5)
+        ttk.Label(threads_frame, text="(больше 1 - для сетевых дисков NFS/SMB)", 
+                 font=('Arial', 8)).pack(side=tk.LEFT)
+        
+        ttk.Checkbutton(options_frame, text="Быстрое пересканирование (только измененные папки)", 
+                       variable=self.incremental_scan).grid(row=2, column=0, columnspan=3, sticky=tk.W, pady=(5, 0))
+        
+        ttk.Checkbutton(options_frame, text="Хранить результаты в SQLite (большие папки, повторное открытие)", 
+                       variable=self.use_sqlite).grid(row=3, column=0, columnspan=3, sticky=tk.W, pady=(5, 0))
+        
         ttk.Label(settings_frame, text="Фильтр расширений:").grid(row=1, column=0, sticky=tk.W, pady=(10, 0))
         
         self.extensions_var = tk.StringVar()
@@ -507,6 +3462,14 @@ class FileScannerGUI:
         self.progress = ttk.Progressbar(progress_frame, mode='determinate')
         self.progress.grid(row=0, column=0, sticky=(tk.W, tk.E), pady=(0, 5))
         
+        self.pause_button = ttk.Button(progress_frame, text="⏸ Пауза (F6)", 
+                                      command=self.toggle_pause, state='disabled')
+        self.pause_button.grid(row=0, column=1, padx=(10, 0), pady=(0, 5))
+        
+        self.stop_button = ttk.Button(progress_frame, text="⏹ Стоп (Esc)", 
+                                     command=self.cancel_scan, state='disabled')
+        self.stop_button.grid(row=0, column=2, padx=(10, 0), pady=(0, 5))
+        
         self.progress_var = tk.StringVar(value="Готов к сканированию")
         progress_label = ttk.Label(progress_frame, textvariable=self.progress_var)
         progress_label.grid(row=1, column=0)
@@ -520,8 +3483,8 @@ class FileScannerGUI:
         stats_label = ttk.Label(results_frame, textvariable=self.stats_var, font=('Arial', 10, 'bold'))
         stats_label.grid(row=0, column=0, sticky=tk.W, pady=(0, 5))
         
-        columns = ('name', 'path', 'size', 'extension', 'modified', 'tags')
-        self.tree = ttk.Treeview(results_frame, columns=columns, show='headings', height=15)
+        self.results_table = ResultsTable(results_frame, height=15)
+        self.tree = self.results_table.tree
         
         self.tree.heading('name', text='Имя файла ▲▼', command=lambda: self.sort_column('name'))
         self.tree.heading('path', text='Путь ▲▼', command=lambda: self.sort_column('path'))
@@ -539,48 +3502,83 @@ class FileScannerGUI:
         
         self.sort_column_name = None
         self.sort_reverse = False
+        self.sort_results = queue.Queue()
+        self.sorts_running = 0
+        # Позиции найденных файлов, пока в таблице результаты поиска, иначе None
+        self.results_subset = None
         
-        v_scrollbar = ttk.Scrollbar(results_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        # Вертикальная прокрутка у ResultsTable своя: она двигает окно строк, а не Treeview
         h_scrollbar = ttk.Scrollbar(results_frame, orient=tk.HORIZONTAL, command=self.tree.xview)
-        self.tree.configure(yscrollcommand=v_scrollbar.set, xscrollcommand=h_scrollbar.set)
+        self.tree.configure(xscrollcommand=h_scrollbar.set)
         
         self.tree.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
-        v_scrollbar.grid(row=1, column=1, sticky=(tk.N, tk.S))
+        self.results_table.scrollbar.grid(row=1, column=1, sticky=(tk.N, tk.S))
         h_scrollbar.grid(row=2, column=0, sticky=(tk.W, tk.E))
         
         self.create_context_menu()
     
     def sort_column(self, column):
         """Сортировка колонки"""
-        if self.sort_column_name == column:
+        toggled = self.sort_column_name == column
+        if toggled:
             self.sort_reverse = not self.sort_reverse
         else:
             self.sort_reverse = False
             self.sort_column_name = column
         
-        data = []
-        for child in self.tree.get_children():
-            values = self.tree.item(child)['values']
-            data.append((child, values))
-        
-        if column == 'name':
-            data.sort(key=lambda x: x[1][0].lower(), reverse=self.sort_reverse)
-        elif column == 'path':
-            data.sort(key=lambda x: x[1][1].lower(), reverse=self.sort_reverse)
-        elif column == 'size':
-            data.sort(key=lambda x: float(str(x[1][2]).replace(' 🔴', '').replace(' 🟡', '').replace(' 🟢', '')) if x[1][2] else 0, reverse=self.sort_reverse)
-        elif column == 'extension':
-            data.sort(key=lambda x: x[1][3].lower(), reverse=self.sort_reverse)
-        elif column == 'modified':
-            data.sort(key=lambda x: x[1][4], reverse=self.sort_reverse)
-        elif column == 'tags':
-            data.sort(key=lambda x: x[1][5], reverse=self.sort_reverse)
-        
-        for index, (child, values) in enumerate(data):
-            self.tree.move(child, '', index)
-        
+        table = self.results_table
+        if toggled and not self.sorts_running and isinstance(table.items, SortedView):
+            # Смена направления - тот же порядок с конца, пересортировка не нужна
+            table.set_items(table.items.reversed(), table.fetch)
+            self.update_column_headers()
+        else:
+            self.request_sort()
+    
+    def request_sort(self):
+        """Упорядочить таблицу по текущей колонке в фоновом потоке, окно не замирает"""
+        table = self.results_table
+        column, reverse = self.sort_column_name, self.sort_reverse
+        items, fetch, version = table.items, table.fetch, table.version
+        store, positions = self.files_data, self.results_subset
+        
+        def sort_items():
+            try:
+                if fetch is not None:
+                    # Хранилище (или найденная часть): у него ключи и перестановки уже могут быть готовы
+                    result = store.sorted_view(column, reverse, positions)
+                else:
+                    key = RECORD_SORT_KEYS[column]
+                    result = SortedView(items, argsort([key(file_info) for file_info in items]), reverse)
+            except Exception as e:
+                # Хранилище могли закрыть, пока шла сортировка
+                print(f"Ошибка сортировки: {e}")
+                result = None
+            self.sort_results.put((column, reverse, version, result))
+        
+        self.sorts_running += 1
+        threading.Thread(target=sort_items, daemon=True).start()
+        if self.sorts_running == 1:
+            self.root.after(SORT_POLL_MS, self.poll_sort)
         self.update_column_headers()
     
+    def poll_sort(self):
+        """Показать готовую сортировку, если таблица и выбранная колонка с тех пор не сменились"""
+        table = self.results_table
+        while True:
+            try:
+                column, reverse, version, result = self.sort_results.get_nowait()
+            except queue.Empty:
+                break
+            self.sorts_running -= 1
+            if (result is not None and version == table.version and
+                    (column, reverse) == (self.sort_column_name, self.sort_reverse)):
+                table.set_items(result, table.fetch)
+        
+        if self.sorts_running:
+            self.root.after(SORT_POLL_MS, self.poll_sort)
+        else:
+            self.update_column_headers()
+    
     def update_column_headers(self):
         """Обновить заголовки колонок с индикаторами сортировки"""
         headers = {
@@ -595,6 +3593,8 @@ class FileScannerGUI:
         for col in headers:
             if col == self.sort_column_name:
                 arrow = ' ▼' if self.sort_reverse else ' ▲'
+                if self.sorts_running:
+                    arrow += ' ⏳'
                 self.tree.heading(col, text=headers[col] + arrow)
             else:
                 self.tree.heading(col, text=headers[col] + ' ▲▼')
@@ -607,7 +3607,7 @@ class FileScannerGUI:
         
         search_window = tk.Toplevel(self.root)
         search_window.title("🔍 Поиск файлов")
-        search_window.geometry("400x150")
+        search_window.geometry("400x190")
         search_window.transient(self.root)
         search_window.grab_set()
         
@@ -616,8 +3616,8 @@ class FileScannerGUI:
         
         search_window.update_idletasks()
         x = self.root.winfo_x() + (self.root.winfo_width() // 2) - (400 // 2)
-        y = self.root.winfo_y() + (self.root.winfo_height() // 2) - (150 // 2)
-        search_window.geometry(f"400x150+{x}+{y}")
+        y = self.root.winfo_y() + (self.root.winfo_height() // 2) - (190 // 2)
+        search_window.geometry(f"400x190+{x}+{y}")
         
         ttk.Label(search_window, text="Поиск в именах файлов и тегах:", font=('Arial', 12)).pack(pady=10)
         
@@ -625,31 +3625,36 @@ class FileScannerGUI:
         search_entry = ttk.Entry(search_window, textvariable=search_var, width=40)
         search_entry.pack(pady=5)
         search_entry.focus()
+        ttk.Label(search_window, text="текст* - начало имени, #тег - точный тег, path:папка - путь",
+                  font=('Arial', 9)).pack()
         
-        def perform_search():
-            query = search_var.get().lower()
+        def show_found(typing=False):
+            """Результаты обновляются по мере ввода: поиск идет по индексу"""
+            query = search_var.get().strip()
             if not query:
+                if self.results_subset is not None:
+                    self.update_results()
+                return
+            if typing and len(query) < LIVE_SEARCH_MIN_CHARS:
+                # Один-два символа индекс не сужает: такой запрос ищется по Enter
                 return
             
-            for item in self.tree.get_children():
-                self.tree.delete(item)
+            started = time.perf_counter()
+            found = self.files_data.search(query)
+            elapsed = (time.perf_counter() - started) * 1000
+            self.results_subset = found
+            self.results_table.set_items(SortedView(self.files_data.view(), found), self.files_data.fetch)
+            if self.sort_column_name is not None:
+                self.request_sort()
             
-            found_count = 0
-            for file_info in self.files_data:
-                if (query in file_info['name'].lower() or 
-                    query in ' '.join(file_info.get('ai_tags', [])).lower()):
-                    tags_str = ', '.join(file_info.get('ai_tags', []))
-                    self.tree.insert('', 'end', values=(
-                        file_info['name'],
-                        file_info['full_path'],
-                        file_info['size_mb'],
-                        file_info['extension'],
-                        file_info['modified_date'],
-                        tags_str
-                    ))
-                    found_count += 1
-            
-            self.stats_var.set(f"Найдено: {found_count} файлов по запросу '{query}'")
+            status = f"Найдено: {len(found)} файлов по запросу '{query}' ({elapsed:.0f} мс)"
+            indexed = len(self.files_data.search_index)
+            if indexed < len(self.files_data):
+                status += f" - индекс поиска строится, просмотрено {indexed * 100 // len(self.files_data)}%"
+            self.stats_var.set(status)
+        
+        def perform_search():
+            show_found()
             search_window.destroy()
         
         def reset_search():
@@ -664,6 +3669,7 @@ class FileScannerGUI:
         ttk.Button(buttons_frame, text="Отмена", command=search_window.destroy).pack(side=tk.LEFT, padx=10)
         
         search_entry.bind('<Return>', lambda e: perform_search())
+        search_var.trace_add('write', lambda *args: show_found(typing=True))
     
     def show_rule_editor(self, item=None, rules_tree=None):
         """Показать редактор правил"""
@@ -806,6 +3812,7 @@ class FileScannerGUI:
                     "✅"
                 ))
             
+            self.compile_ai_rules()
             messagebox.showinfo("Успех", f"Правило '{category_name}' сохранено!")
             self.save_settings()
             editor_window.destroy()
@@ -847,6 +3854,8 @@ class FileScannerGUI:
         
         ttk.Checkbutton(local_settings_frame, text="Включить локальные AI теги", 
                        variable=self.ai_enabled).pack(anchor=tk.W)
+        ttk.Checkbutton(local_settings_frame, text="Считать правила во всех ядрах (процессы, для сотен категорий)", 
+                       variable=self.tag_processes).pack(anchor=tk.W)
         
         rules_frame = ttk.Frame(local_frame)
         rules_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
@@ -900,6 +3909,7 @@ class FileScannerGUI:
                 category = rules_tree.item(item)['values'][0].lower()
                 if category in self.ai_tag_patterns:
                     del self.ai_tag_patterns[category]
+                    self.compile_ai_rules()
                 rules_tree.delete(item)
                 self.save_settings()
                 messagebox.showinfo("Успех", "Правило удалено!")
@@ -926,6 +3936,38 @@ class FileScannerGUI:
         ttk.Label(api_frame, text="🔑 API ключ:").pack(side=tk.LEFT)
         ttk.Entry(api_frame, textvariable=self.openai_api_key, width=40, show="*").pack(side=tk.LEFT, padx=10, fill=tk.X, expand=True)
         
+        workers_frame = ttk.Frame(openai_main_frame)
+        workers_frame.pack(fill=tk.X, pady=5)
+        
+        ttk.Label(workers_frame, text="⚡ Запросов одновременно:").pack(side=tk.LEFT)
+        ttk.Spinbox(workers_frame, from_=1, to=32, textvariable=self.openai_workers, 
+                    width=4).pack(side=tk.LEFT, padx=10)
+        
+        limit_frame = ttk.Frame(openai_main_frame)
+        limit_frame.pack(fill=tk.X, pady=5)
+        
+        ttk.Label(limit_frame, text="💰 Дневной лимит, $:").pack(side=tk.LEFT)
+        ttk.Entry(limit_frame, textvariable=self.daily_limit, width=8).pack(side=tk.LEFT, padx=10)
+        ttk.Label(limit_frame, text=f"сегодня потрачено ${self.budget.cost_today():.4f}", 
+                 font=('Arial', 8)).pack(side=tk.LEFT)
+        
+        deadline_frame = ttk.Frame(openai_main_frame)
+        deadline_frame.pack(fill=tk.X, pady=5)
+        
+        ttk.Label(deadline_frame, text="⏱️ Времени на OpenAI за сканирование, мин:").pack(side=tk.LEFT)
+        ttk.Spinbox(deadline_frame, from_=0, to=1440, textvariable=self.openai_deadline, 
+                    width=5).pack(side=tk.LEFT, padx=10)
+        ttk.Label(deadline_frame, text="(0 - без ограничения)", font=('Arial', 8)).pack(side=tk.LEFT)
+        
+        url_frame = ttk.Frame(openai_main_frame)
+        url_frame.pack(fill=tk.X, pady=5)
+        
+        ttk.Label(url_frame, text="🌐 Адрес API:").pack(side=tk.LEFT)
+        ttk.Entry(url_frame, textvariable=self.openai_base_url, width=40).pack(side=tk.LEFT, padx=10, fill=tk.X, expand=True)
+        
+        ttk.Checkbutton(openai_main_frame, text="Несколько файлов в одном запросе (меньше запросов и токенов)", 
+                       variable=self.openai_batching).pack(anchor=tk.W, pady=5)
+        
         test_frame = ttk.LabelFrame(openai_frame, text="Тестирование", padding="15")
         test_frame.pack(fill=tk.X, padx=10, pady=5)
         
@@ -947,18 +3989,18 @@ class FileScannerGUI:
             settings_window.update()
             
             if self.openai_api_key.get():
-                fake_file_info = {
-                    'name': filename,
-                    'size_mb': 2.5,
-                    'extension': os.path.splitext(filename)[1] or '.unknown'
-                }
+                now = time.time()
+                fake_file_info = FileRecord(filename, DirectoryTable(''), 0,
+                                            os.path.splitext(filename)[1] or '.unknown',
+                                            int(2.5 * 1024 * 1024), now, now)
                 
                 ai_tags = self.generate_openai_tags(fake_file_info)
+                self.save_usage()
                 
                 if ai_tags:
                     test_result.insert(tk.END, f"✅ OpenAI теги: {', '.join(ai_tags)}\n")
-                    test_result.insert(tk.END, f"⚡ Токенов: ~{self.tokens_used_today}\n")
-                    cost_today = self.tokens_used_today * 0.0015 / 1000
+                    test_result.insert(tk.END, f"⚡ Токенов сегодня: {self.budget.tokens_today()}\n")
+                    cost_today = self.budget.cost_today()
                     test_result.insert(tk.END, f"💰 Стоимость: ~${cost_today:.4f}")
                 else:
                     test_result.insert(tk.END, "❌ Ошибка получения тегов от OpenAI\nПроверьте API ключ и подключение")
@@ -995,6 +4037,8 @@ class FileScannerGUI:
                        variable=self.ai_for_documents).pack(anchor=tk.W, pady=2)
         ttk.Checkbutton(ai_filters_frame, text="Для проектов и папок", 
                        variable=self.ai_for_projects).pack(anchor=tk.W, pady=2)
+        ttk.Checkbutton(ai_filters_frame, text="Один запрос на семейство (IMG_0001.jpg … IMG_9999.jpg)", 
+                       variable=self.cluster_templates).pack(anchor=tk.W, pady=2)
         
         cache_frame = ttk.LabelFrame(advanced_frame, text="Кэширование", padding="15")
         cache_frame.pack(fill=tk.X, padx=10, pady=5)
@@ -1002,10 +4046,50 @@ class FileScannerGUI:
         ttk.Checkbutton(cache_frame, text="Кэшировать результаты AI (экономия токенов)", 
                        variable=self.enable_cache).pack(anchor=tk.W, pady=2)
         
-        cache_info = ttk.Label(cache_frame, text="📁 Кэш: 0 файлов, 0 MB", font=('Arial', 9))
+        cache_limit_frame = ttk.Frame(cache_frame)
+        cache_limit_frame.pack(anchor=tk.W, pady=2)
+        
+        ttk.Label(cache_limit_frame, text="Максимум записей:").pack(side=tk.LEFT)
+        ttk.Spinbox(cache_limit_frame, from_=100, to=10000000, increment=10000, 
+                    textvariable=self.cache_max_entries, width=10).pack(side=tk.LEFT, padx=5)
+        
+        cache_info = ttk.Label(cache_frame, text=self.cache_status_text(), font=('Arial', 9))
         cache_info.pack(anchor=tk.W, pady=2)
         
-        ttk.Button(cache_frame, text="🗑️ Очистить кэш").pack(anchor=tk.W, pady=5)
+        def clear_cache():
+            cache = self.get_tag_cache()
+            if cache is None:
+                return
+            if messagebox.askyesno("Подтверждение", f"Удалить из кэша {len(cache)} записей?"):
+                cache.clear()
+                cache_info.config(text=self.cache_status_text())
+        
+        ttk.Button(cache_frame, text="🗑️ Очистить кэш", command=clear_cache).pack(anchor=tk.W, pady=5)
+        
+        learned_frame = ttk.LabelFrame(advanced_frame, text="Обучаемая модель тегов", padding="15")
+        learned_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ttk.Checkbutton(learned_frame, text="Сначала спрашивать модель, обученную на кэше OpenAI", 
+                       variable=self.learned_tagger).pack(anchor=tk.W, pady=2)
+        
+        threshold_frame = ttk.Frame(learned_frame)
+        threshold_frame.pack(anchor=tk.W, pady=2)
+        
+        ttk.Label(threshold_frame, text="В OpenAI, если уверенность ниже:").pack(side=tk.LEFT)
+        ttk.Spinbox(threshold_frame, from_=0.5, to=0.99, increment=0.05, 
+                    textvariable=self.learned_threshold, width=6).pack(side=tk.LEFT, padx=5)
+        
+        def train_classifier():
+            classifier = self.get_tag_classifier()
+            if classifier is None:
+                messagebox.showinfo("Модель тегов", 
+                                   f"В кэше меньше {LEARNED_MIN_EXAMPLES} файлов для модели {self.openai_model.get()}")
+                return
+            messagebox.showinfo("Модель тегов", 
+                               f"✅ Модель обучена на {classifier.examples} файлах, "
+                               f"тегов: {len(classifier.tags)}")
+        
+        ttk.Button(learned_frame, text="🎓 Обучить на кэше", command=train_classifier).pack(anchor=tk.W, pady=5)
         
         bottom_frame = ttk.Frame(settings_window)
         bottom_frame.pack(fill=tk.X, padx=10, pady=10)
@@ -1028,7 +4112,7 @@ class FileScannerGUI:
         
         filter_window = tk.Toplevel(self.root)
         filter_window.title("🔧 Фильтрация файлов")
-        filter_window.geometry("400x200")
+        filter_window.geometry("520x430")
         filter_window.transient(self.root)
         filter_window.grab_set()
         
@@ -1036,58 +4120,91 @@ class FileScannerGUI:
             filter_window.configure(bg='#1e1e1e')
         
         filter_window.update_idletasks()
-        x = self.root.winfo_x() + (self.root.winfo_width() // 2) - (400 // 2)
-        y = self.root.winfo_y() + (self.root.winfo_height() // 2) - (200 // 2)
-        filter_window.geometry(f"400x200+{x}+{y}")
-        
-        ttk.Label(filter_window, text="Фильтр по размеру файла:", font=('Arial', 12)).pack(pady=10)
-        
-        size_frame = ttk.Frame(filter_window)
-        size_frame.pack(pady=5)
-        
-        ttk.Label(size_frame, text="Размер больше:").pack(side=tk.LEFT)
-        size_var = tk.StringVar(value="0")
-        size_entry = ttk.Entry(size_frame, textvariable=size_var, width=10)
-        size_entry.pack(side=tk.LEFT, padx=5)
-        ttk.Label(size_frame, text="MB").pack(side=tk.LEFT)
-        
-        ttk.Label(filter_window, text="Фильтр по расширению:", font=('Arial', 12)).pack(pady=(20, 5))
-        
-        ext_var = tk.StringVar()
-        ext_entry = ttk.Entry(filter_window, textvariable=ext_var, width=20)
-        ext_entry.pack(pady=5)
+        x = self.root.winfo_x() + (self.root.winfo_width() // 2) - (520 // 2)
+        y = self.root.winfo_y() + (self.root.winfo_height() // 2) - (430 // 2)
+        filter_window.geometry(f"520x430+{x}+{y}")
+        
+        ttk.Label(filter_window, text="Все заполненные условия должны выполняться:",
+                  font=('Arial', 12)).pack(pady=10)
+        
+        fields_frame = ttk.Frame(filter_window)
+        fields_frame.pack(padx=15, fill=tk.X)
+        
+        def add_range(row, label, hint):
+            ttk.Label(fields_frame, text=label).grid(row=row, column=0, sticky=tk.W, pady=3)
+            low_var = tk.StringVar()
+            high_var = tk.StringVar()
+            ttk.Entry(fields_frame, textvariable=low_var, width=12).grid(row=row, column=1, padx=5)
+            ttk.Label(fields_frame, text="—").grid(row=row, column=2)
+            ttk.Entry(fields_frame, textvariable=high_var, width=12).grid(row=row, column=3, padx=5)
+            ttk.Label(fields_frame, text=hint, font=('Arial', 8)).grid(row=row, column=4, sticky=tk.W)
+            return low_var, high_var
+        
+        def add_field(row, label, hint):
+            ttk.Label(fields_frame, text=label).grid(row=row, column=0, sticky=tk.W, pady=3)
+            var = tk.StringVar()
+            ttk.Entry(fields_frame, textvariable=var, width=30).grid(row=row, column=1, columnspan=3, padx=5,
+                                                                    sticky=(tk.W, tk.E))
+            ttk.Label(fields_frame, text=hint, font=('Arial', 8)).grid(row=row, column=4, sticky=tk.W)
+            return var
+        
+        size_vars = add_range(0, "Размер:", "MB")
+        modified_vars = add_range(1, "Изменен:", "ГГГГ-ММ-ДД")
+        created_vars = add_range(2, "Создан:", "ГГГГ-ММ-ДД")
+        ext_var = add_field(3, "Расширения:", ".jpg, .png")
+        tags_var = add_field(4, "С тегами:", "все из списка")
+        exclude_var = add_field(5, "Без тегов:", "ни одного")
+        glob_var = add_field(6, "Путь (шаблон):", "*.jpg или */фото/*")
+        regex_var = add_field(7, "Имя (рег. выр.):", r"^img_\d+")
+        
+        def parse_size(text):
+            return float(text.replace(',', '.')) * 1024 * 1024 if text.strip() else None
+        
+        def parse_date(text, end=False):
+            """Начало дня; для правой границы - начало следующего дня"""
+            if not text.strip():
+                return None
+            day = datetime.strptime(text.strip(), '%Y-%m-%d')
+            return day.timestamp() + (86400 if end else 0)
+        
+        def split_list(text):
+            return [part.strip() for part in text.split(',') if part.strip()]
         
         def apply_filter():
             try:
-                min_size = float(size_var.get())
+                sizes = [parse_size(var.get()) for var in size_vars]
+            except ValueError:
+                messagebox.showerror("Ошибка", "Размер должен быть числом в MB")
+                return
+            try:
+                modified = (parse_date(modified_vars[0].get()), parse_date(modified_vars[1].get(), end=True))
+                created = (parse_date(created_vars[0].get()), parse_date(created_vars[1].get(), end=True))
             except ValueError:
-                min_size = 0
+                messagebox.showerror("Ошибка", "Дата должна быть в формате ГГГГ-ММ-ДД")
+                return
             
-            ext_filter = ext_var.get().lower().strip()
+            extensions = [ext if ext.startswith('.') or ext == 'нет' else '.' + ext
+                          for ext in split_list(ext_var.get().lower())]
+            try:
+                file_filter = FileFilter(sizes[0], sizes[1], extensions, modified, created,
+                                         split_list(tags_var.get()), split_list(exclude_var.get()),
+                                         glob_var.get().strip(), regex_var.get().strip())
+            except re.error as e:
+                messagebox.showerror("Ошибка", f"Неверное регулярное выражение: {e}")
+                return
             
-            for item in self.tree.get_children():
-                self.tree.delete(item)
+            started = time.perf_counter()
+            found, searched = self.files_data.filter(file_filter)
+            elapsed = (time.perf_counter() - started) * 1000
+            self.results_subset = found
+            self.results_table.set_items(SortedView(self.files_data.view(), found), self.files_data.fetch)
+            if self.sort_column_name is not None:
+                self.request_sort()
             
-            found_count = 0
-            for file_info in self.files_data:
-                if file_info['size_mb'] >= min_size:
-                    if not ext_filter or file_info['extension'].lower() == ext_filter:
-                        tags_str = ', '.join(file_info.get('ai_tags', []))
-                        self.tree.insert('', 'end', values=(
-                            file_info['name'],
-                            file_info['full_path'],
-                            file_info['size_mb'],
-                            file_info['extension'],
-                            file_info['modified_date'],
-                            tags_str
-                        ))
-                        found_count += 1
-            
-            filter_desc = f"размер ≥ {min_size}MB"
-            if ext_filter:
-                filter_desc += f", расширение: {ext_filter}"
-            
-            self.stats_var.set(f"Отфильтровано: {found_count} файлов ({filter_desc})")
+            status = f"Отфильтровано: {len(found)} файлов ({file_filter.describe()}; {elapsed:.0f} мс)"
+            if file_filter.uses_index() and len(self.files_data.search_index) < len(self.files_data):
+                status += f" - индекс поиска строится, просмотрено {searched * 100 // len(self.files_data)}%"
+            self.stats_var.set(status)
             filter_window.destroy()
         
         def reset_filter():
@@ -1164,29 +4281,33 @@ class FileScannerGUI:
         self.context_menu.add_separator()
         self.context_menu.add_command(label="Показать свойства", command=self.show_properties)
         
-        self.tree.bind("<Button-3>", self.show_context_menu)
+        # add: правый клик сначала выделяет строку под курсором (привязка ResultsTable)
+        self.tree.bind("<Button-3>", self.show_context_menu, add='+')
     
     def show_context_menu(self, event):
         """Показать контекстное меню"""
-        item = self.tree.selection()[0] if self.tree.selection() else None
-        if item:
+        if self.results_table.record_id(self.tree.identify_row(event.y)) is not None:
             self.context_menu.post(event.x_root, event.y_root)
     
+    def selected_record(self):
+        """Запись выделенной строки по ее id в хранилище, без поиска по путям"""
+        record_id = self.results_table.selected_id()
+        return self.files_data.record(record_id) if record_id is not None else None
+    
     def copy_path(self):
         """Копировать путь к файлу"""
-        item = self.tree.selection()[0] if self.tree.selection() else None
-        if item:
-            path = self.tree.item(item)['values'][1]
+        file_info = self.selected_record()
+        if file_info:
+            path = file_info.full_path
             self.root.clipboard_clear()
             self.root.clipboard_append(path)
             messagebox.showinfo("Скопировано", f"Путь скопирован в буфер обмена:\n{path}")
     
     def open_folder(self):
         """Открыть папку с файлом"""
-        item = self.tree.selection()[0] if self.tree.selection() else None
-        if item:
-            path = self.tree.item(item)['values'][1]
-            folder = os.path.dirname(path)
+        file_info = self.selected_record()
+        if file_info:
+            folder = file_info.directory
             try:
                 if os.name == 'nt':
                     os.startfile(folder)
@@ -1201,31 +4322,86 @@ class FileScannerGUI:
     
     def show_properties(self):
         """Показать свойства файла"""
-        item = self.tree.selection()[0] if self.tree.selection() else None
-        if item:
-            values = self.tree.item(item)['values']
-            name, path, size, ext, modified, tags = values
-            
-            file_info = None
-            for f in self.files_data:
-                if f['full_path'] == path:
-                    file_info = f
-                    break
-            
-            if file_info:
-                tags_str = ', '.join(file_info.get('ai_tags', []))
-                props_text = f"""Свойства файла:
-
-Имя: {file_info['name']}
-Полный путь: {file_info['full_path']}
-Размер: {file_info['size_mb']} MB ({file_info['size_bytes']} байт)
-Расширение: {file_info['extension']}
-Создан: {file_info['created_date']}
-Изменен: {file_info['modified_date']}
-Папка: {file_info['directory']}
+        file_info = self.selected_record()
+        if file_info:
+            tags_str = ', '.join(file_info.ai_tags)
+            props_text = f"""Свойства файла:
+
+Имя: {file_info.name}
+Полный путь: {file_info.full_path}
+Размер: {file_info.size_mb} MB ({file_info.size_bytes} байт)
+Расширение: {file_info.extension}
+Создан: {file_info.created_date}
+Изменен: {file_info.modified_date}
+Папка: {file_info.directory}
 🤖 AI Теги: {tags_str}"""
-                
-                messagebox.showinfo("Свойства файла", props_text)
+            
+            messagebox.showinfo("Свойства файла", props_text)
+    
+    def browse_store(self):
+        """Открыть сохраненное SQLite сканирование без повторного обхода"""
+        path = filedialog.askopenfilename(
+            title="Открыть сохраненное сканирование",
+            initialdir=self.get_store_dir(),
+            filetypes=[("SQLite", "*.sqlite3"), ("Все файлы", "*.*")])
+        if path:
+            self.open_store(path)
+    
+    def get_store_dir(self):
+        """Папка для SQLite хранилищ сканирований"""
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.join(script_dir, 'scans')
+    
+    def create_store(self, directory, use_sqlite):
+        """Новое хранилище для сканирования: SQLite или память"""
+        self.close_store()
+        if not use_sqlite:
+            self.last_store = None
+            return ScanStore(directory)
+        
+        folder_name = os.path.basename(os.path.normpath(directory)) or "root"
+        folder_name = "".join(c for c in folder_name if c.isalnum() or c in (' ', '-', '_'))
+        key = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:8]
+        os.makedirs(self.get_store_dir(), exist_ok=True)
+        path = os.path.join(self.get_store_dir(), f"{folder_name}-{key}.sqlite3")
+        self.last_store = path
+        return SQLiteScanStore(path, scanned_folder=directory)
+    
+    def open_store(self, path):
+        """Показать результаты из сохраненного SQLite хранилища"""
+        if self.scanning:
+            messagebox.showinfo("Информация", "Сканирование уже выполняется!")
+            return
+        try:
+            store = SQLiteScanStore(path)
+        except sqlite3.Error as e:
+            messagebox.showerror("Ошибка", f"Не удалось открыть сканирование: {e}")
+            return
+        
+        self.close_store()
+        self.files_data = store
+        self.last_store = path
+        if store.scanned_folder:
+            self.folder_var.set(store.scanned_folder)
+        self.total_files_to_scan = len(store)
+        self.update_results()
+        self.progress_var.set(f"Открыто сохраненное сканирование: {len(store)} файлов")
+        threading.Thread(target=self.index_store, args=(store,), daemon=True).start()
+    
+    def index_store(self, store):
+        """Фоновый поток: индекс поиска для открытого с диска сканирования"""
+        try:
+            store.update_search_index()
+        except sqlite3.Error as e:
+            # Хранилище закрыли (новое сканирование или другое открытое) до конца индексации
+            print(f"Индексация для поиска прервана: {e}")
+    
+    def close_store(self):
+        """Закрыть текущее хранилище результатов"""
+        try:
+            self.files_data.close()
+        except sqlite3.Error as e:
+            print(f"Ошибка закрытия хранилища: {e}")
     
     def browse_folder(self):
         """Выбор папки"""
@@ -1248,128 +4424,435 @@ class FileScannerGUI:
             messagebox.showinfo("Информация", "Сканирование уже выполняется!")
             return
         
-        thread = threading.Thread(target=self.scan_files, args=(folder,))
+        resume = False
+        settings = self.get_scan_settings()
+        checkpoint = ScanCheckpoint(self.get_checkpoint_file(folder), os.path.abspath(folder),
+                                    self.get_scan_index_params(settings))
+        header = checkpoint.find()
+        if header is not None:
+            answer = messagebox.askyesnocancel(
+                "Прерванное сканирование",
+                f"Сканирование этой папки от {format_timestamp(header['started'] / 10**9)} не было завершено.\n\n"
+                "Продолжить с места остановки? (Нет - начать заново)")
+            if answer is None:
+                return
+            resume = answer
+        
+        # Хранилище меняем здесь же: таблица читает старое, пока не переключена на новое,
+        # поэтому закрывать его из потока сканирования нельзя
+        try:
+            store = self.create_store(folder, settings.use_sqlite)
+        except (sqlite3.Error, OSError) as e:
+            messagebox.showerror("Ошибка", f"Не удалось создать хранилище результатов: {e}")
+            return
+        self.files_data = store
+        self.sort_column_name = None
+        self.update_column_headers()
+        self.update_results()
+        
+        # Виджеты трогаем только здесь и в poll_scan_progress - в главном потоке
+        self.scanning = True
+        self.scan_button.config(state='disabled')
+        self.pause_button.config(state='normal', text="⏸ Пауза (F6)")
+        self.stop_button.config(state='normal')
+        self.progress_var.set("Сканирование...")
+        previous_count = self.scan_counts.get(os.path.abspath(folder), 0)
+        self.progress.config(mode='determinate', maximum=max(previous_count, 1))
+        self.progress['value'] = 0
+        self.scan_progress = ScanProgress(previous_count)
+        
+        thread = threading.Thread(target=self.scan_files,
+                                  args=(folder, self.scan_progress, resume, settings, store))
         thread.daemon = True
         thread.start()
+        self.root.after(1000 // PROGRESS_FPS, self.poll_scan_progress)
+    
+    def toggle_pause(self):
+        """Пауза: обход ждет, начатые пакеты дорабатывают"""
+        progress = self.scan_progress
+        if not self.scanning or progress is None or progress.cancelled.is_set():
+            return
+        if progress.paused:
+            progress.resume()
+            self.pause_button.config(text="⏸ Пауза (F6)")
+        else:
+            progress.pause()
+            self.pause_button.config(text="▶ Продолжить (F6)")
     
-    def scan_files(self, directory):
-        """Сканирование файлов с прогрессом"""
+    def cancel_scan(self):
+        """Остановить сканирование; найденное остается в таблице и в контрольной точке"""
+        progress = self.scan_progress
+        if not self.scanning or progress is None:
+            return
+        progress.cancel()
+        self.pause_button.config(state='disabled')
+        self.stop_button.config(state='disabled')
+        self.progress_var.set("Остановка сканирования...")
+    
+    def poll_scan_progress(self):
+        """Опрос канала прогресса с частотой PROGRESS_FPS, пока сканирование не закончится"""
+        progress = self.scan_progress
+        finished = False
+        for kind, payload in progress.drain():
+            if kind == 'store':
+                # Новое сканирование показывается по мере поступления, с начала и без сортировки
+                self.sort_column_name = None
+                self.update_column_headers()
+                self.update_results()
+            elif kind == 'results':
+                if self.showing_store():
+                    # Пользователь мог уже листать таблицу: позицию не сбрасываем
+                    self.results_table.extend_items(self.files_data.view())
+                    self.update_statistics()
+                else:
+                    self.update_results()
+            elif kind == 'error':
+                messagebox.showerror("Ошибка", f"Ошибка при сканировании: {payload}")
+            elif kind == 'finished':
+                finished = True
+        
+        if finished:
+            self.scan_complete()
+            return
+        snapshot = progress.snapshot()
+        self.update_progress(snapshot)
+        
+        # Пока показано само хранилище, новые записи дописываются в таблицу; отсортированный
+        # или найденный срез остается как есть до конца сканирования
+        table = self.results_table
+        if self.showing_store():
+            table.extend_items(self.files_data.view())
+            self.stats_var.set(self.format_statistics(
+                snapshot.files, snapshot.bytes / (1024 * 1024), snapshot.extensions) + " | ⏳ идет сканирование")
+        self.root.after(1000 // PROGRESS_FPS, self.poll_scan_progress)
+    
+    def showing_store(self):
+        """В таблице все хранилище без сортировки: новые записи можно дописывать в конец"""
+        return (self.results_table.fetch is not None and self.results_subset is None and
+                self.sort_column_name is None)
+    
+    def make_file_info(self, name, dir_id, file_ext, size, mtime, ctime):
+        """Собрать запись о файле из сырых данных stat"""
+        return FileRecord(name, self.files_data.dirs, dir_id, file_ext or 'нет', size, mtime, ctime)
+    
+    def stat_batch(self, batch):
+        """Стадия stat: записи о файлах пакета (из DirEntry или из индекса папок)"""
+        if batch.tagged:
+            for file, file_ext, size, mtime, ctime, ai_tags in batch.entries:
+                file_info = self.make_file_info(file, batch.dir_id, file_ext, size, mtime, ctime)
+                file_info.ai_tags = ai_tags
+                batch.records.append(file_info)
+            batch.rows = batch.entries
+            return
+        
+        for file, entry, file_ext in batch.entries:
+            try:
+                # DirEntry кэширует stat (на Windows он уже получен из каталога)
+                stat = entry.stat()
+            except OSError:
+                continue
+            batch.records.append(self.make_file_info(file, batch.dir_id, file_ext,
+                                                     stat.st_size, stat.st_mtime, stat.st_ctime))
+            batch.rows.append([file, file_ext, stat.st_size, stat.st_mtime, stat.st_ctime, None])
+    
+    def template_batch(self, batch):
+        """Стадия шаблонов: семейство каждого файла (IMG_0001.jpg и IMG_0002.jpg - одно)"""
+        batch.templates = [name_template(file_info.name) for file_info in batch.records]
+    
+    def local_tag_batch(self, batch):
+        """Стадия локальных тегов"""
+        if not batch.tagged:
+            settings = self.scan_settings
+            batch.local_tags = [self.generate_ai_tags(file_info, settings) for file_info in batch.records]
+    
+    def learned_tag_batch(self, batch):
+        """Стадия модели: теги от TagClassifier для файлов, которые иначе ушли бы в OpenAI"""
+        if batch.tagged:
+            return
+        classifier = self.tag_classifier
+        threshold = self.scan_settings.learned_threshold
+        route = self.scan_settings.route
+        batch.learned_tags = []
+        for file_info, local_tags in zip(batch.records, batch.local_tags):
+            tags = None
+            if self.needs_openai(file_info, local_tags, route):
+                predicted, confidence = classifier.predict(file_info.name, file_info.extension,
+                                                           int(file_info.size_bytes).bit_length())
+                if predicted and confidence >= threshold:
+                    tags = predicted
+            batch.learned_tags.append(tags)
+    
+    def process_tag_batches(self, batches):
+        """Стадия локальных тегов в пуле процессов: одна задача на несколько тысяч файлов"""
+        batches = [batch for batch in batches if not batch.tagged]
+        rows = [(file_info.name.lower(), file_info.full_path.lower(), file_info.extension.lower(),
+                 file_info.size_mb, file_info.mtime)
+                for batch in batches for file_info in batch.records]
+        results = self.tag_pool.submit(tag_chunk, rows).result() if rows else []
+        
+        offset = 0
+        for batch in batches:
+            count = len(batch.records)
+            # Обрезаем до 5 так же, как generate_ai_tags, уже в этом процессе
+            batch.local_tags = [list(set(tags))[:5] for tags in results[offset:offset + count]]
+            offset += count
+    
+    def remote_tag_batch(self, batches):
+        """Стадия OpenAI: добавляет теги модели к локальным (пакетами, если включено)"""
+        batches = [batch for batch in batches if not batch.tagged]
+        settings = self.scan_settings
+        route = settings.route
+        openai_tags = {}
+        records = []
+        templates = []
+        for batch in batches:
+            learned_tags = batch.learned_tags or [None] * len(batch.records)
+            for file_info, template, local_tags, tags in zip(batch.records, batch.templates,
+                                                             batch.local_tags, learned_tags):
+                # Уверенный ответ модели заменяет запрос к OpenAI
+                if tags is not None:
+                    openai_tags[id(file_info)] = tags
+                elif self.needs_openai(file_info, local_tags, route):
+                    records.append(file_info)
+                    templates.append(template)
+        with self.openai_client_lock:
+            self.learned_used += len(openai_tags)
+        if settings.cluster_templates:
+            tags = self.clustered_openai_tags(records, templates, settings)
+        else:
+            with self.openai_client_lock:
+                self.openai_routed += len(records)
+            tags = self.cached_openai_tags(records, settings)
+        openai_tags.update(zip(map(id, records), tags))
+        
+        for batch in batches:
+            for file_info, row, local_tags in zip(batch.records, batch.rows, batch.local_tags):
+                file_info.ai_tags = self.merge_ai_tags(local_tags, openai_tags.get(id(file_info), []), route[0])
+                row[5] = file_info.ai_tags
+    
+    def scan_files(self, directory, progress=None, resume=False, settings=None, store=None):
+        """Сканирование файлов; интерфейс узнает о ходе работы только через канал progress
+        
+        resume - продолжить прерванное сканирование: папки из контрольной точки
+        берутся готовыми, как из индекса, и заново не читаются.
+        settings - снимок get_scan_settings из главного потока; переменные Tk
+        из потоков сканирования не читаются. store - хранилище, созданное start_scan;
+        без него оно создается здесь, и таблица переключается по событию 'store'.
+        """
         self.scanning = True
-        self.scan_button.config(state='disabled')
-        self.progress.config(mode='indeterminate')
-        self.progress.start()
-        self.progress_var.set("Подсчет файлов...")
+        if progress is None:
+            progress = ScanProgress()
+        if settings is None:
+            settings = self.get_scan_settings()
+        self.scan_settings = settings
+        checkpoint = None
+        completed = False
         
         try:
-            self.files_data = []
+            if store is None:
+                self.files_data = self.create_store(directory, settings.use_sqlite)
+                progress.post('store')
             
-            include_hidden = self.include_hidden.get()
-            extensions_text = self.extensions_var.get().strip()
-            file_extensions = None
+            # Прогресс оцениваем по прошлому сканированию этой папки или по ходу обхода,
+            # без отдельного прохода для подсчета файлов
+            scan_key = os.path.abspath(directory)
+            previous_count = self.scan_counts.get(scan_key, 0)
             
-            if extensions_text:
-                file_extensions = [ext.strip().lower() for ext in extensions_text.split() if ext.strip()]
+            index_params = self.get_scan_index_params(settings)
+            save_index = settings.incremental_scan
+            index = None
+            if save_index:
+                index = ScanIndex(self.get_scan_index_file(directory), index_params)
+                index.load()
             
-            self.total_files_to_scan = 0
-            for root, dirs, files in os.walk(directory):
-                if not include_hidden:
-                    dirs[:] = [d for d in dirs if not d.startswith('.')]
-                
-                for file in files:
-                    if not include_hidden and file.startswith('.'):
-                        continue
-                    
-                    file_ext = os.path.splitext(file)[1].lower()
-                    if file_extensions and file_ext not in file_extensions:
-                        continue
+            checkpoint = ScanCheckpoint(self.get_checkpoint_file(directory), scan_key, index_params)
+            restored = checkpoint.load() if resume else None
+            if restored is not None:
+                if index is None:
+                    index = ScanIndex(self.get_scan_index_file(directory), index_params)
+                index.restore(*restored)
+                print(f"⏯️ Продолжение прерванного сканирования: готовых папок {len(restored[1])}")
+            checkpoint.start(restored)
+            
+            walker = DirectoryWalker(settings.include_hidden, settings.file_extensions, index)
+            scan_threads = settings.scan_threads
+            if scan_threads > 1:
+                walk = walker.walk_parallel(directory, scan_threads, progress.running)
+            else:
+                walk = walker.walk(directory)
+            
+            self.budget.start_scan()
+            self.scan_requests = InflightRequests()
+            self.scan_templates = InflightRequests()
+            self.openai_routed = 0
+            self.learned_used = 0
+            deadline_minutes = settings.openai_deadline
+            self.remote_deadline = time.monotonic() + deadline_minutes * 60 if deadline_minutes else None
+            self.remote_deadline_hit = False
+            self.breaker.reset_stats()
+            self.total_files_to_scan = previous_count
+            
+            dirs = self.files_data.dirs
+            dir_ids = {directory: 0}
+            
+            def batches():
+                """Стадия обхода: папки режутся на пакеты по PIPELINE_CHUNK_SIZE файлов"""
+                seq = 0
+                for listing in walk:
+                    dir_id = dir_ids.pop(listing.root)
+                    for subdir in listing.subdirs:
+                        dir_ids[subdir] = dirs.add(dir_id, os.path.basename(subdir))
                     
-                    self.total_files_to_scan += 1
+                    # Папка не менялась: записи вместе с AI тегами берутся из индекса
+                    files = listing.cached if listing.cached is not None else listing.files
+                    # Пустая папка тоже дает пакет, чтобы попасть в индекс
+                    starts = range(0, len(files), PIPELINE_CHUNK_SIZE) or [0]
+                    for start in starts:
+                        end = start + PIPELINE_CHUNK_SIZE
+                        yield ScanBatch(seq, dir_id, listing, files[start:end], end >= len(files))
+                        seq += 1
             
-            self.progress.stop()
-            self.progress.config(mode='determinate', maximum=self.total_files_to_scan)
-            self.scan_progress = 0
+            dir_rows = []
             
-            for root, dirs, files in os.walk(directory):
-                if not include_hidden:
-                    dirs[:] = [d for d in dirs if not d.startswith('.')]
+            def sink(batch):
+                """Приемник: пакеты приходят в порядке обхода"""
+                for file_info in batch.records:
+                    self.files_data.append(file_info)
+                self.files_data.templates.update(batch.templates)
+                dir_rows.extend(batch.rows)
+                if batch.last:
+                    listing = batch.listing
+                    if listing.stat is not None:
+                        entry = ScanIndex.entry(listing.stat, listing.subdirs, list(dir_rows))
+                        if save_index:
+                            index.remember(listing.root, entry)
+                        checkpoint.add(listing.root, entry)
+                    dir_rows.clear()
                 
-                for file in files:
-                    if not include_hidden and file.startswith('.'):
-                        continue
-                    
-                    file_path = os.path.join(root, file)
-                    file_ext = os.path.splitext(file)[1].lower()
-                    
-                    if file_extensions and file_ext not in file_extensions:
-                        continue
-                    
-                    try:
-                        stat = os.stat(file_path)
-                        file_info = {
-                            'name': file,
-                            'full_path': file_path,
-                            'relative_path': os.path.relpath(file_path, directory),
-                            'directory': root,
-                            'extension': file_ext or 'нет',
-                            'size_bytes': stat.st_size,
-                            'size_mb': round(stat.st_size / (1024 * 1024), 3),
-                            'modified_date': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
-                            'created_date': datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S')
-                        }
-                        
-                        file_info['ai_tags'] = self.combine_ai_tags(file_info)
-                        
-                        self.files_data.append(file_info)
-                        
-                        self.scan_progress += 1
-                        progress_percent = (self.scan_progress / self.total_files_to_scan) * 100
-                        self.root.after(0, self.update_progress, self.scan_progress, progress_percent)
-                        
-                    except (PermissionError, OSError):
-                        continue
+                progress.advance(batch.records, batch.listing.root, walker.estimate_total(previous_count))
+            
+            local_stage = PipelineStage('теги', self.local_tag_batch)
+            if settings.tag_processes and settings.ai_enabled:
+                processes = os.cpu_count() or 1
+                # spawn: fork процесса с живыми потоками (Tk, обход) небезопасен
+                self.tag_pool = ProcessPoolExecutor(max_workers=processes,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=init_tag_worker,
+                                                    initargs=(settings.rules,))
+                local_stage = PipelineStage('теги', self.process_tag_batches, processes,
+                                            gather=TAG_PROCESS_CHUNK_SIZE)
+            
+            stages = [PipelineStage('stat', self.stat_batch), PipelineStage('шаблоны', self.template_batch),
+                      local_stage]
+            if (settings.learned_tagger and settings.openai_enabled and settings.openai_api_key
+                    and self.get_tag_classifier(settings) is not None):
+                stages.append(PipelineStage('модель', self.learned_tag_batch))
+            stages.append(PipelineStage('OpenAI', self.remote_tag_batch, settings.openai_workers,
+                                        gather=OPENAI_BATCH_FILES))
+            
+            self.pipeline = ScanPipeline(batches(), stages, sink,
+                                         cancelled=progress.cancelled, running=progress.running)
+            self.pipeline.run()
+            self.pipeline.print_report()
+            cancelled = progress.cancelled.is_set()
+            
+            if self.tag_cache is not None:
+                self.tag_cache.flush()
+                print(f"🗂️ Кэш AI: попаданий {self.tag_cache.hits}, промахов {self.tag_cache.misses}")
+            
+            if settings.openai_enabled:
+                print(f"🧭 В OpenAI направлено файлов: {self.openai_routed} из {len(self.files_data)}, "
+                      f"повторов в сканировании: {self.scan_requests.deduplicated}, "
+                      f"теги семейства получили: {self.scan_templates.deduplicated}")
+                if self.learned_used:
+                    print(f"🎓 Теги модели вместо OpenAI: {self.learned_used} файлов")
+                if self.breaker.trips:
+                    print(f"⚡ Предохранитель OpenAI срабатывал {self.breaker.trips} раз, "
+                          f"пропущено запросов: {self.breaker.skipped}")
             
-            self.root.after(0, self.update_results)
+            budget_report = self.budget.report(settings.daily_limit)
+            if budget_report:
+                print(budget_report)
+                self.save_usage()
+            
+            if index is not None:
+                print(f"♻️ Из индекса взято папок: {index.reused_dirs} из {walker.dirs_done}")
+            
+            self.files_data.flush()
+            self.total_files_to_scan = len(self.files_data)
+            if cancelled:
+                # Неполный обход не должен вытеснить из индекса папки, до которых не дошли
+                print(f"⏹ Сканирование остановлено: {len(self.files_data)} файлов, "
+                      f"контрольная точка: {checkpoint.path}")
+            else:
+                if save_index:
+                    try:
+                        index.save()
+                    except OSError as e:
+                        print(f"Ошибка сохранения индекса папок: {e}")
+                checkpoint.remove()
+                completed = True
+                self.scan_counts[scan_key] = len(self.files_data)
+            progress.post('results')
             
         except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Ошибка", f"Ошибка при сканировании: {e}"))
+            progress.post('error', str(e))
         finally:
+            if checkpoint is not None and not completed:
+                try:
+                    checkpoint.write()
+                except OSError as e:
+                    print(f"Ошибка сохранения контрольной точки: {e}")
+            self.remote_deadline = None
+            if self.tag_pool is not None:
+                self.tag_pool.shutdown(cancel_futures=True)
+                self.tag_pool = None
             self.scanning = False
-            self.root.after(0, self.scan_complete)
+            progress.post('finished')
     
-    def update_progress(self, current, percent):
-        """Обновление прогресса"""
-        self.progress['value'] = current
-        self.progress_var.set(f"Сканирование... {current}/{self.total_files_to_scan} ({percent:.1f}%)")
+    def update_progress(self, snapshot):
+        """Обновление прогресса по снимку канала ScanProgress"""
+        expected = max(snapshot.expected, 1)
+        self.progress.config(maximum=expected)
+        self.progress['value'] = snapshot.files
+        size_mb = snapshot.bytes / (1024 * 1024)
+        size_text = f"{size_mb / 1024:.2f} GB" if size_mb > 1024 else f"{size_mb:.1f} MB"
+        status = (f"Сканирование... {snapshot.files}/~{snapshot.expected} ({snapshot.files / expected * 100:.1f}%)"
+                  f" · {snapshot.rate:.0f} ф/с · {size_text}")
+        if self.scan_progress is not None and self.scan_progress.paused:
+            status += " · ⏸ пауза"
+        elif snapshot.eta is not None:
+            status += f" · осталось ~{format_duration(snapshot.eta)}"
+        if self.pipeline is not None and self.scanning:
+            status += f"  | очереди: {self.pipeline.status_text()}"
+        if snapshot.directory:
+            directory = snapshot.directory
+            status += f"\n📂 {directory if len(directory) <= 80 else '…' + directory[-79:]}"
+        self.progress_var.set(status)
     
     def scan_complete(self):
         """Завершение сканирования"""
         self.progress.stop()
+        self.progress.config(maximum=max(self.total_files_to_scan, 1))
         self.progress['value'] = self.total_files_to_scan
         self.scan_button.config(state='normal')
-        self.progress_var.set(f"Сканирование завершено: {len(self.files_data)} файлов")
+        self.pause_button.config(state='disabled', text="⏸ Пауза (F6)")
+        self.stop_button.config(state='disabled')
+        self.save_settings()
+        if self.scan_progress is not None and self.scan_progress.cancelled.is_set():
+            self.progress_var.set(f"Сканирование остановлено: {len(self.files_data)} файлов "
+                                  f"(F5 - продолжить с места остановки)")
+        else:
+            self.progress_var.set(f"Сканирование завершено: {len(self.files_data)} файлов")
+        if self.closing:
+            self.root.destroy()
     
     def update_results(self):
-        """Обновление результатов в интерфейсе"""
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        for file_info in self.files_data:
-            tags_str = ', '.join(file_info.get('ai_tags', []))
-            item = self.tree.insert('', 'end', values=(
-                file_info['name'],
-                file_info['full_path'],
-                file_info['size_mb'],
-                file_info['extension'],
-                file_info['modified_date'],
-                tags_str
-            ))
-            
-            if file_info['size_mb'] > 100:
-                self.tree.set(item, 'size', f"{file_info['size_mb']} 🔴")
-            elif file_info['size_mb'] > 10:
-                self.tree.set(item, 'size', f"{file_info['size_mb']} 🟡")
-            else:
-                self.tree.set(item, 'size', f"{file_info['size_mb']} 🟢")
+        """Обновление результатов в интерфейсе (с текущей сортировкой)"""
+        self.results_subset = None
+        self.results_table.set_items(self.files_data.view(), self.files_data.fetch)
+        if self.sort_column_name is not None:
+            self.request_sort()
         
         self.update_statistics()
     
@@ -1379,14 +4862,19 @@ class FileScannerGUI:
             self.stats_var.set("Файлы не найдены")
             return
         
-        total_files = len(self.files_data)
-        total_size_mb = sum(f['size_mb'] for f in self.files_data)
-        total_size_gb = total_size_mb / 1024
+        stats_text = self.format_statistics(len(self.files_data), self.files_data.total_size_mb(),
+                                            self.files_data.extension_stats())
         
-        extensions = {}
-        for file_info in self.files_data:
-            ext = file_info['extension']
-            extensions[ext] = extensions.get(ext, 0) + 1
+        families = [(template, count) for template, count in self.files_data.template_stats().most_common()
+                    if count > 1]
+        if families:
+            family_text = ", ".join([f"{template} ×{count}" for template, count in families[:3]])
+            stats_text += f" | 🧩 Семейств: {len(families)} ({family_text})"
+        self.stats_var.set(stats_text)
+    
+    def format_statistics(self, total_files, total_size_mb, extensions):
+        """Строка статистики: число файлов, размер и топ расширений"""
+        total_size_gb = total_size_mb / 1024
         
         top_extensions = sorted(extensions.items(), key=lambda x: x[1], reverse=True)[:5]
         ext_text = ", ".join([f"{ext}: {count}" for ext, count in top_extensions])
@@ -1396,8 +4884,7 @@ class FileScannerGUI:
         else:
             size_text = f"{total_size_mb:.2f} MB"
         
-        stats_text = f"📁 Файлов: {total_files} | 💾 Размер: {size_text} | 🏆 Топ: {ext_text}"
-        self.stats_var.set(stats_text)
+        return f"📁 Файлов: {total_files} | 💾 Размер: {size_text} | 🏆 Топ: {ext_text}"
     
     def save_to_txt(self, filename):
         """Сохранение в текстовый файл"""
@@ -1407,25 +4894,39 @@ class FileScannerGUI:
             f.write(f"📅 Дата сканирования: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
             f.write(f"📁 Сканированная папка: {self.folder_var.get()}\n")
             f.write(f"📊 Всего найдено файлов: {len(self.files_data)}\n")
-            total_size = sum(f['size_mb'] for f in self.files_data)
+            total_size = self.files_data.total_size_mb()
             f.write(f"💾 Общий размер: {total_size:.2f} MB ({total_size/1024:.2f} GB)\n\n")
             
-            extensions = {}
-            for file_info in self.files_data:
-                ext = file_info['extension']
-                extensions[ext] = extensions.get(ext, 0) + 1
+            extensions = self.files_data.extension_stats()
             
             f.write("📈 СТАТИСТИКА ПО РАСШИРЕНИЯМ:\n")
             f.write("-" * 30 + "\n")
             for ext, count in sorted(extensions.items(), key=lambda x: x[1], reverse=True):
                 f.write(f"{ext}: {count} файлов\n")
             
+            sizes, counts = self.files_data.directory_totals()
+            top_dirs = sorted(range(len(sizes)), key=sizes.__getitem__, reverse=True)[:10]
+            f.write("\n📂 КРУПНЕЙШИЕ ПАПКИ (вместе с подпапками):\n")
+            f.write("-" * 30 + "\n")
+            for dir_id in top_dirs:
+                if counts[dir_id]:
+                    f.write(f"{self.files_data.dirs.path(dir_id)}: {counts[dir_id]} файлов, "
+                            f"{sizes[dir_id] / (1024 * 1024):.2f} MB\n")
+            
+            families = [(template, count) for template, count in self.files_data.template_stats().most_common(10)
+                        if count > 1]
+            if families:
+                f.write("\n🧩 СЕМЕЙСТВА ФАЙЛОВ (по шаблону имени):\n")
+                f.write("-" * 30 + "\n")
+                for template, count in families:
+                    f.write(f"{template}: {count} файлов\n")
+            
             f.write("\n📋 СПИСОК ФАЙЛОВ:\n")
             f.write("-" * 30 + "\n")
-            for file_info in sorted(self.files_data, key=lambda x: x['size_mb'], reverse=True):
-                size_indicator = "🔴" if file_info['size_mb'] > 100 else "🟡" if file_info['size_mb'] > 10 else "🟢"
-                tags_str = ', '.join(file_info.get('ai_tags', []))
-                f.write(f"{size_indicator} {file_info['full_path']} ({file_info['size_mb']} MB) [Теги: {tags_str}]\n")
+            for file_info in self.files_data.by_size():
+                size_indicator = "🔴" if file_info.size_mb > 100 else "🟡" if file_info.size_mb > 10 else "🟢"
+                tags_str = ', '.join(file_info.ai_tags)
+                f.write(f"{size_indicator} {file_info.full_path} ({file_info.size_mb} MB) [Теги: {tags_str}]\n")
     
     def save_to_csv(self, filename):
         """Сохранение в CSV файл"""
@@ -1436,18 +4937,14 @@ class FileScannerGUI:
             ])
             writer.writeheader()
             for file_info in self.files_data:
-                file_info_copy = file_info.copy()
-                file_info_copy['ai_tags'] = ', '.join(file_info.get('ai_tags', []))
+                file_info_copy = file_info.to_dict()
+                file_info_copy['ai_tags'] = ', '.join(file_info.ai_tags)
                 writer.writerow(file_info_copy)
     
     def save_to_json(self, filename):
         """Сохранение в JSON файл"""
-        extensions = {}
-        for file_info in self.files_data:
-            ext = file_info['extension']
-            extensions[ext] = extensions.get(ext, 0) + 1
-        
-        total_size_mb = sum(f['size_mb'] for f in self.files_data)
+        extensions = self.files_data.extension_stats()
+        total_size_mb = self.files_data.total_size_mb()
         
         data = {
             'scan_info': {
@@ -1458,10 +4955,10 @@ class FileScannerGUI:
                 'total_size_mb': round(total_size_mb, 2),
                 'total_size_gb': round(total_size_mb / 1024, 2),
                 'extensions_stats': extensions,
-                'largest_files': sorted(self.files_data, key=lambda x: x['size_mb'], reverse=True)[:10],
+                'largest_files': [f.to_dict() for f in self.files_data.by_size(10)],
                 'ai_enabled': self.ai_enabled.get()
             },
-            'files': self.files_data
+            'files': [f.to_dict() for f in self.files_data]
         }
         
         with open(filename, 'w', encoding='utf-8') as f:
@@ -1469,14 +4966,18 @@ class FileScannerGUI:
     
     def clear_results(self):
         """Очистка результатов"""
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        if self.scanning:
+            # Хранилище пополняет конвейер сканирования: закрывать его сейчас нельзя
+            messagebox.showinfo("Информация", "Дождитесь окончания сканирования или остановите его (Esc)")
+            return
+        self.results_table.clear()
         
-        self.files_data = []
+        self.close_store()
+        self.files_data = ScanStore()
+        self.last_store = None
         self.stats_var.set("Готов к сканированию")
         self.progress_var.set("Готов к сканированию")
         self.progress['value'] = 0
-        self.scan_progress = 0
         self.total_files_to_scan = 0
     
     def show_help(self):
@@ -1518,7 +5019,9 @@ class FileScannerGUI:
 🟢 Маленькие файлы (<10 MB)
 
 ⌨️ ГОРЯЧИЕ КЛАВИШИ:
-F5 - Сканировать
+F5 - Сканировать (прерванное сканирование можно продолжить)
+F6 - Пауза / продолжить
+Esc - Остановить сканирование
 F3 - Поиск (по именам и тегам)
 F2 - Настройки AI
 F1 - Справка
@@ -1548,4 +5051,7 @@ def main():
     root.mainloop()
 
 if __name__ == "__main__":
+    # В собранном PyInstaller exe процессы пула тегов запускают тот же exe:
+    # freeze_support выполняет в них задачу пула вместо открытия окна
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file